@@ -1,69 +1,642 @@
 import streamlit as st
+import asyncio
+import atexit
+import collections
+import concurrent.futures
+import contextlib
 import datetime
-import json
+import functools
+import hashlib
+import inspect
+import itertools
 import os
+import pathlib
 import re
 import logging
+import logging.handlers
+import queue
+import tempfile
+import threading
 from textwrap import dedent
 import time
 
+import fasteners
+import httpx
+import tiktoken
+import zstandard as zstd
+
 from agno.agent import Agent
 from agno.models.perplexity import Perplexity
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('guideline_app.log')
-    ]
-)
+# Records are queued and written to the console and log file by a background
+# listener thread, so logging never blocks the research pipeline on disk I/O.
+# Streamlit re-executes this script on every rerun, so only set this up once.
+if not any(isinstance(handler, logging.handlers.QueueHandler) for handler in logging.getLogger().handlers):
+    log_queue = queue.Queue(-1)
+    log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    log_handlers = [logging.StreamHandler(), logging.FileHandler('guideline_app.log')]
+    for handler in log_handlers:
+        handler.setFormatter(log_formatter)
+
+    log_listener = logging.handlers.QueueListener(log_queue, *log_handlers)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+    logging.getLogger().addHandler(logging.handlers.QueueHandler(log_queue))
+    logging.getLogger().setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Precompiled regular expressions used to parse model output and build file names
+_SAFE_TOPIC_RE = re.compile(r'[^\w.-]')
+_BOLD_RE = re.compile(r'\*\*([^*]+)\*\*')
+_H3_SPLIT_RE = re.compile(r'^### ', re.MULTILINE)
+_PUB_DATE_RE = re.compile(r'Original Publication: (\w+ \d{4}) by ([^|]+)')
+_SECTION_RE = re.compile(r'### ([^\n]+)')
+_TABLE_ROW_RE = re.compile(r'\|.*\|.*\|')
+_NUMBERED_REF_RE = re.compile(r'^(?:\d+\.|\[\d+\])\s+.+')  # Matches "1. Reference..." or "[1] Reference..."
+_NUM_LIST_RE = re.compile(r'^\d+\.\s+')
+
 # Use perplexity API key from environment
 perplexity_api_key = os.environ.get("PERPLEXITY_API_KEY")
 if not perplexity_api_key:
     logger.error("PERPLEXITY_API_KEY not found in environment variables")
 
-# Initialize the agent with Perplexity model
-def create_perplexity_agent(use_fast_research=False):
+# Directory for generated guideline documents, created once at import
+OUTPUT_DIR = "tmp"
+os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+# Directory holding one cache file per research result
+CACHE_DIR = os.path.join(OUTPUT_DIR, "cache")
+# Cache files older than this, or beyond this many entries, are purged on startup
+CACHE_MAX_AGE_DAYS = 7
+CACHE_MAX_ENTRIES = 500
+# Research results are reused for at most this many seconds
+CACHE_MAX_AGE = CACHE_MAX_AGE_DAYS * 86400
+
+# Cached markdown is highly repetitive, so each file is stored zstd-compressed
+CACHE_SUFFIX = ".md.zst"
+_CCTX = zstd.ZstdCompressor(level=3)
+_DCTX = zstd.ZstdDecompressor()
+
+def is_expired(written_at, max_age):
+    """Check whether an entry written at written_at is older than max_age seconds"""
+    return max_age is not None and time.time() - written_at > max_age
+
+class CacheStore:
+    """Disk cache that keeps every research result in its own file"""
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+        # Create the directory once here rather than on every read and write
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def mtime(self, key):
+        """Return the modification time of the cache file for key in nanoseconds, or None if nothing is cached"""
+        try:
+            return os.stat(self._path(key) + CACHE_SUFFIX).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def entry(self, key):
+        """Return (value, written_at) for key, or None if nothing is cached"""
+        try:
+            with open(self._path(key) + CACHE_SUFFIX, "rb") as f:
+                written_at = os.fstat(f.fileno()).st_mtime
+                return _DCTX.decompress(f.read()).decode("utf-8"), written_at
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Error reading cache: {str(e)}")
+            return None
+
+    def set(self, key, value):
+        """Write value to the compressed cache file for key atomically"""
+        path = self._path(key)
+        data = _CCTX.compress(value.encode("utf-8"))
+        with fasteners.InterProcessLock(path + ".lock"):
+            with tempfile.NamedTemporaryFile("wb", dir=self.cache_dir, suffix=".tmp", delete=False) as f:
+                f.write(data)
+            os.replace(f.name, path + CACHE_SUFFIX)
+
+    def purge(self, max_age_days=CACHE_MAX_AGE_DAYS, max_entries=CACHE_MAX_ENTRIES):
+        """Delete cache files older than max_age_days and all but the newest max_entries"""
+        try:
+            entries = [(entry.stat().st_mtime, entry.path[:-len(CACHE_SUFFIX)])
+                       for entry in os.scandir(self.cache_dir) if entry.name.endswith(CACHE_SUFFIX)]
+        except FileNotFoundError:
+            return 0
+
+        # Newest first, so everything past max_entries is least recently written
+        entries.sort(reverse=True)
+        cutoff = time.time() - max_age_days * 86400
+        stale = [path for i, (mtime, path) in enumerate(entries) if mtime < cutoff or i >= max_entries]
+        for path in stale:
+            for suffix in (CACHE_SUFFIX, ".lock"):
+                try:
+                    os.remove(path + suffix)
+                except FileNotFoundError:
+                    pass
+        return len(stale)
+
+    def clear(self):
+        """Delete every cache file and return how many entries were removed"""
+        return self.purge(max_entries=0)
+
+cache_store = CacheStore()
+
+# Function to purge stale cache files in the background, once per process
+@st.cache_resource(show_spinner=False)
+def start_cache_purge():
+    """Start a daemon thread that removes expired cache files"""
+    def purge():
+        try:
+            removed = cache_store.purge()
+            logger.info(f"Purged {removed} stale cache files")
+        except Exception as e:
+            logger.error(f"Error purging cache: {str(e)}")
+
+    thread = threading.Thread(target=purge, name="cache-purge", daemon=True)
+    thread.start()
+    return thread
+
+# In-process memo in front of the disk cache; unlike module globals it survives Streamlit reruns.
+# Entries are keyed by file mtime, so a file rewritten by any process is read again.
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
+def _memo_lookup(key, mtime_ns):
+    entry = cache_store.entry(key)
+    if entry is None:
+        # Raising keeps misses out of the memo, so later writes are picked up
+        raise KeyError(key)
+    return entry
+
+def cached_result(key, max_age=None):
+    """Return the cached value for key from memory or disk, or None if nothing is cached or it is older than max_age seconds"""
+    # A stat is enough to detect misses and rewrites without reading the file
+    mtime_ns = cache_store.mtime(key)
+    if mtime_ns is None:
+        return None
+    try:
+        value, written_at = _memo_lookup(key, mtime_ns)
+    except KeyError:
+        return None
+    return None if is_expired(written_at, max_age) else value
+
+# Single background writer, so cache writes never hold up the research path
+@st.cache_resource(show_spinner=False)
+def _cache_executor():
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache-writer")
+    # Flush queued writes before the interpreter exits
+    atexit.register(executor.shutdown, wait=True)
+    return executor
+
+def _persist_result(key, value):
+    try:
+        cache_store.set(key, value)
+    except Exception as e:
+        logger.error(f"Error writing to cache: {str(e)}")
+
+def store_result(key, value):
+    """Queue value to be written to the disk cache; the new file mtime makes later lookups skip the old in-memory copy"""
+    _cache_executor().submit(_persist_result, key, value)
+
+def research_cache_key(*parts, use_fast_research=False):
+    """Build a cache key from parts plus the research mode; entries expire by age, not by date"""
+    # Research mode is part of the key to avoid mixing fast and deep research results
+    research_mode = "fast" if use_fast_research else "deep"
+    return "_".join([*parts, research_mode])
+
+def content_hash(*texts):
+    """Short digest of the inputs a result was built from, for cache keys of derived steps"""
+    digest = hashlib.sha1()
+    for text in texts:
+        digest.update(text.encode("utf-8", errors="replace"))
+        # Separator so that moving text from one input to the next changes the digest
+        digest.update(b"\0")
+    return digest.hexdigest()[:12]
+
+class ResearchError(Exception):
+    """Raised by a research function that failed; the message is the fallback text to show"""
+
+# Decorator caching the result of an async research function
+def disk_cached(key_fn, max_age=CACHE_MAX_AGE):
+    """Cache results under key_fn(**arguments) for up to max_age seconds unless the call passes use_cache=False"""
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        # Cached call that lets ResearchError through, for callers that need to tell failures apart
+        @functools.wraps(fn)
+        async def strict(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            use_cache = arguments.arguments.get("use_cache", True)
+            cache_key = key_fn(**arguments.arguments)
+
+            if use_cache:
+                cached = cached_result(cache_key, max_age)
+                if cached is not None:
+                    logger.info(f"Using cached result for {cache_key}")
+                    return cached
+
+            # Failures raise before reaching the cache, so they are never stored
+            result = await fn(*args, **kwargs)
+
+            if use_cache:
+                store_result(cache_key, result)
+
+            return result
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await strict(*args, **kwargs)
+            except ResearchError as e:
+                # Failures are shown to the user as the fallback text
+                return str(e)
+
+        wrapper.strict = strict
+        return wrapper
+
+    return decorator
+
+# Limits for requests sent to Perplexity
+PERPLEXITY_MAX_CONCURRENCY = 8
+PERPLEXITY_TOKENS_PER_MINUTE = 200000
+PERPLEXITY_REQUESTS_PER_SECOND = 8
+# Retries of throttled (429), timed-out and 5xx requests, made by the OpenAI SDK under agno.
+# agno turns provider errors into an errored run rather than raising, so retrying can't be done around it;
+# the SDK backs off exponentially with jitter and honours Retry-After
+PERPLEXITY_MAX_RETRIES = 3
+
+# Per-request token budget; the prompt and the response must fit under the cap together
+PERPLEXITY_REQUEST_TOKEN_CAP = 6000
+PERPLEXITY_MAX_OUTPUT_TOKENS = 4096
+PERPLEXITY_MIN_OUTPUT_TOKENS = 1024
+
+# Optional prompt sections dropped, in this order, when a prompt runs over budget
+_TRIMMABLE_SECTION_RES = [
+    re.compile(rf'^## {heading}\n.*?(?=^#|\Z)', re.MULTILINE | re.DOTALL)
+    for heading in ("Background Context", "Research Context")
+]
+
+def _load_token_encoding():
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # Remembered as None, so a failed download is not retried for every prompt
+        logger.warning(f"Could not load tokenizer, estimating tokens from prompt length: {str(e)}")
+        return None
+
+# tiktoken downloads its encoding on first use, so it is loaded once per process on a background thread
+@st.cache_resource(show_spinner=False)
+def _token_encoding_future():
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="tokenizer-load")
+    future = executor.submit(_load_token_encoding)
+    executor.shutdown(wait=False)
+    return future
+
+@functools.lru_cache(maxsize=256)
+def _count_tokens(prompt):
+    return len(_token_encoding_future().result().encode(prompt))
+
+def estimate_tokens(prompt):
+    """Estimate the number of tokens in a prompt without waiting for the tokenizer to load"""
+    future = _token_encoding_future()
+    if not future.done() or future.result() is None:
+        # Until the tokenizer is ready, or if it failed to load, assume ~4 characters per token
+        return len(prompt) // 4
+    return _count_tokens(prompt)
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text down to about max_tokens tokens, marking where it was cut"""
+    future = _token_encoding_future()
+    encoding = future.result() if future.done() else None
+    if encoding is None:
+        # Same ~4 characters per token estimate as estimate_tokens
+        return text[:max_tokens * 4] + "\n\n[...truncated]"
+    return encoding.decode(encoding.encode(text)[:max_tokens]) + "\n\n[...truncated]"
+
+# Function to fill a prompt template, shortening embedded model output so the prompt fits the budget
+def format_prompt_within_budget(template, inputs, **fields):
+    """Format template with inputs and fields, cutting the longest inputs so the minimum response still fits the cap"""
+    prompt = template.format(**inputs, **fields)
+    excess = estimate_tokens(prompt) - (PERPLEXITY_REQUEST_TOKEN_CAP - PERPLEXITY_MIN_OUTPUT_TOKENS)
+    if excess <= 0:
+        return prompt
+
+    # Lower a shared per-input limit until cutting every input down to it removes the excess,
+    # so the longest inputs are shortened first and short ones are left whole
+    sizes = {name: estimate_tokens(value) for name, value in inputs.items()}
+    limit = max(sizes.values())
+    while limit > 0 and sum(max(0, size - limit) for size in sizes.values()) < excess:
+        limit -= 64
+    limit = max(limit, 0)
+    logger.warning(f"Prompt is {excess} tokens over budget, cutting embedded inputs to {limit} tokens each")
+    shortened = {name: truncate_to_tokens(value, limit) if sizes[name] > limit else value for name, value in inputs.items()}
+    return template.format(**shortened, **fields)
+
+# Function to fit a prompt and its response into the per-request token budget
+def fit_prompt_to_budget(prompt):
+    """Trim optional context from an oversized prompt and return it with its max_tokens"""
+    prompt_tokens = estimate_tokens(prompt)
+    for section_re in _TRIMMABLE_SECTION_RES:
+        if prompt_tokens + PERPLEXITY_MAX_OUTPUT_TOKENS <= PERPLEXITY_REQUEST_TOKEN_CAP:
+            break
+        prompt = section_re.sub("", prompt)
+        prompt_tokens = estimate_tokens(prompt)
+
+    if prompt_tokens + PERPLEXITY_MIN_OUTPUT_TOKENS > PERPLEXITY_REQUEST_TOKEN_CAP:
+        # Prompts that embed earlier output are shortened by format_prompt_within_budget; anything
+        # else this long still goes out with the minimum response size, over the cap
+        logger.warning(f"Prompt of {prompt_tokens} tokens exceeds the {PERPLEXITY_REQUEST_TOKEN_CAP}-token request cap")
+    max_tokens = min(PERPLEXITY_MAX_OUTPUT_TOKENS, PERPLEXITY_REQUEST_TOKEN_CAP - prompt_tokens)
+    # Round down to a multiple of 256 so only a few model variants are ever created
+    return prompt, max(PERPLEXITY_MIN_OUTPUT_TOKENS, max_tokens // 256 * 256)
+
+class PerplexityLimiter:
+    """Caps in-flight Perplexity requests, requests per second and the prompt tokens sent per minute"""
+
+    def __init__(self, max_concurrency=PERPLEXITY_MAX_CONCURRENCY, tokens_per_minute=PERPLEXITY_TOKENS_PER_MINUTE,
+                 requests_per_second=PERPLEXITY_REQUESTS_PER_SECOND):
+        # Each Streamlit session runs its workflow in its own event loop on its own thread, so the
+        # state is guarded by a thread lock and waiters are woken on the loop they are waiting in
+        self.lock = threading.Lock()
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        # (loop, future) for every request waiting for a slot, in arrival order
+        self.waiters = collections.deque()
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_second = requests_per_second
+        # (timestamp, tokens) for every request issued in the last 60 seconds
+        self.window = collections.deque()
+        self.window_tokens = 0
+        # Start times of the requests issued in the last second
+        self.recent_starts = collections.deque()
+
+    def _expire(self, now):
+        while self.window and now - self.window[0][0] >= 60:
+            _, tokens = self.window.popleft()
+            self.window_tokens -= tokens
+        while self.recent_starts and now - self.recent_starts[0] >= 1:
+            self.recent_starts.popleft()
+
+    async def _acquire_slot(self):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if self.in_flight < self.max_concurrency and not self.waiters:
+                self.in_flight += 1
+                return
+            waiter = (loop, loop.create_future())
+            self.waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self.lock:
+                try:
+                    self.waiters.remove(waiter)
+                    handed_over = False
+                except ValueError:
+                    handed_over = True
+            # A slot handed over just before the cancellation is passed on; if the wake-up has not
+            # run yet, _wake sees the cancelled future and passes it on instead
+            if handed_over and not waiter[1].cancelled():
+                self._release_slot()
+            raise
+
+    def _wake(self, future):
+        # Runs on the waiter's loop; a waiter cancelled in the meantime passes its slot on
+        if future.cancelled():
+            self._release_slot()
+        else:
+            future.set_result(None)
+
+    def _release_slot(self):
+        with self.lock:
+            # Hand the slot straight to the next waiter, skipping any whose event loop has already finished
+            while self.waiters:
+                loop, future = self.waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self._wake, future)
+                    return
+                except RuntimeError:
+                    continue
+            self.in_flight -= 1
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, estimated_tokens):
+        """Wait until a request slot and enough of the token budget are free"""
+        # A prompt bigger than the whole budget still goes through once the window drains
+        tokens = min(estimated_tokens, self.tokens_per_minute)
+        await self._acquire_slot()
+        try:
+            while True:
+                with self.lock:
+                    now = time.monotonic()
+                    self._expire(now)
+                    if len(self.recent_starts) >= self.requests_per_second:
+                        wait = 1 - (now - self.recent_starts[0])
+                    elif self.window_tokens + tokens > self.tokens_per_minute:
+                        wait = 60 - (now - self.window[0][0])
+                    else:
+                        self.recent_starts.append(now)
+                        self.window.append((now, tokens))
+                        self.window_tokens += tokens
+                        break
+                await asyncio.sleep(wait)
+            yield
+        finally:
+            self._release_slot()
+
+# One limiter for the whole process, shared by every session and kept across reruns
+@st.cache_resource(show_spinner=False)
+def perplexity_limiter():
+    return PerplexityLimiter()
+
+# Maximum number of prompts batch_agent_run keeps in flight at once
+BATCH_CONCURRENCY = 4
+
+# Minimum seconds between re-renders of the status header and progress bar
+UI_UPDATE_INTERVAL = 0.05
+# Minimum seconds between re-renders of a streaming response
+STREAM_RENDER_INTERVAL = 0.05
+# Divider between sections shown together in the progress view
+SECTION_SEPARATOR = "\n\n---\n\n"
+
+class ProgressTracker:
+    """Spreads a progress budget across weighted workflow steps and reports each step's share"""
+
+    def __init__(self, weights, on_update, total=100):
+        # Steps that were not requested have no weight, so the others fill the whole budget
+        weights = {step: weight for step, weight in weights.items() if weight}
+        scale = total / sum(weights.values()) if weights else 0
+        self.shares = {step: weight * scale for step, weight in weights.items()}
+        # Fraction of each step finished so far
+        self.finished = dict.fromkeys(self.shares, 0.0)
+        self.on_update = on_update
+        self.total = total
+        self.done = 0
+
+    def advance(self, step, fraction, message):
+        """Add part of a step's share to the progress and report it"""
+        fraction = min(fraction, 1 - self.finished.get(step, 1))
+        if fraction <= 0:
+            return
+        self.finished[step] += fraction
+        self.done = min(self.done + self.shares[step] * fraction, self.total)
+        self.on_update(message, self.done)
+
+    @contextlib.contextmanager
+    def scope(self, step, message, done_message):
+        """Report the start of a step and add whatever is left of its share when it ends"""
+        self.on_update(message, self.done)
+        try:
+            yield self
+        finally:
+            # Failed steps count as finished too, so the bar still reaches the end
+            self.advance(step, 1, done_message)
+
+# Seconds to wait for deep research before settling for the fast result
+DEEP_RESEARCH_BUDGET = 120
+
+# Perplexity API endpoint, used to open connections ahead of the first request
+PERPLEXITY_BASE_URL = "https://api.perplexity.ai/"
+# Seconds between connection warm-ups while the form is being filled in
+PERPLEXITY_WARMUP_INTERVAL = 60
+
+# Connection pool size, well above PERPLEXITY_MAX_CONCURRENCY so requests never queue for a socket
+PERPLEXITY_MAX_CONNECTIONS = 32
+# Deep research can keep a response open for minutes, so only connecting is held to a short timeout
+PERPLEXITY_HTTP_TIMEOUT = httpx.Timeout(600, connect=10)
+
+# Shared HTTP connection pool for every Perplexity request
+@st.cache_resource(show_spinner=False)
+def _perplexity_http_client():
+    # HTTP/2 multiplexes concurrent requests over one connection, but needs the optional h2 package
+    try:
+        import h2  # noqa: F401
+        http2 = True
+    except ImportError:
+        http2 = False
+    logger.info(f"Perplexity HTTP client using {'HTTP/2' if http2 else 'HTTP/1.1'}")
+    # Idle connections are kept long enough for a warmed-up connection to still be open at submit time
+    return httpx.Client(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=PERPLEXITY_MAX_CONNECTIONS,
+            max_keepalive_connections=PERPLEXITY_MAX_CONNECTIONS,
+            keepalive_expiry=2 * PERPLEXITY_WARMUP_INTERVAL,
+        ),
+        timeout=PERPLEXITY_HTTP_TIMEOUT,
+    )
+
+# Threads that run the blocking agno calls. Kept apart from asyncio's default executor, which asyncio.run
+# waits for on exit, so a request abandoned by cancellation cannot hold up the end of a run
+@st.cache_resource(show_spinner=False)
+def _agent_executor():
+    return concurrent.futures.ThreadPoolExecutor(max_workers=4 * PERPLEXITY_MAX_CONCURRENCY, thread_name_prefix="perplexity-agent")
+
+# Function to open a pooled connection to Perplexity in the background
+def warm_perplexity_connection():
+    """Complete the TCP and TLS handshake with Perplexity before the first research request"""
+    client = _perplexity_http_client()
+
+    def warm():
+        # Any response leaves an open connection in the pool; no model call is made
+        try:
+            client.head(PERPLEXITY_BASE_URL, timeout=10)
+        except Exception as e:
+            logger.warning(f"Could not warm up Perplexity connection: {str(e)}")
+
+    threading.Thread(target=warm, name="perplexity-warmup", daemon=True).start()
+
+# Perplexity model for each research mode and output budget, kept for the life of
+# the process so that every agent reuses the same client and its keep-alive connections
+@st.cache_resource(show_spinner=False)
+def _perplexity_model(use_fast_research=False, max_tokens=PERPLEXITY_MAX_OUTPUT_TOKENS):
     model_id = "sonar-pro" if use_fast_research else "sonar-deep-research"
+    return Perplexity(id=model_id, api_key=perplexity_api_key, max_tokens=max_tokens, max_retries=PERPLEXITY_MAX_RETRIES,
+                      http_client=_perplexity_http_client())
+
+# Initialize the agent with Perplexity model
+def create_perplexity_agent(use_fast_research=False, max_tokens=PERPLEXITY_MAX_OUTPUT_TOKENS):
+    # Agents keep per-run state, so each call gets its own agent around the shared model
     return Agent(
-        model=Perplexity(id=model_id, api_key=perplexity_api_key),
+        model=_perplexity_model(use_fast_research, max_tokens),
         description="Expert medical guideline researcher and analyst",
         markdown=True
     )
 
-# Function to research guideline metadata
-def research_guideline_metadata(topic, use_fast_research=False, use_cache=True):
-    """Research guideline metadata and executive summary"""
-    # Create tmp directory if it doesn't exist
-    os.makedirs("tmp", exist_ok=True)
-
-    # Create cache if needed
-    cache_file = "tmp/guidelines_cache.json"
-    cache_key = f"{topic}_metadata_{datetime.datetime.now().strftime('%Y-%m-%d')}"
-    
-    # Add research mode to cache key to avoid mixing fast and deep research results
-    research_mode = "fast" if use_fast_research else "deep"
-    cache_key = f"{cache_key}_{research_mode}"
+# Function to run a prompt through the agent once, optionally streaming the response
+async def _run_agent_once(prompt, use_fast_research=False, on_chunk=None, max_tokens=PERPLEXITY_MAX_OUTPUT_TOKENS):
+    """Run a prompt through a new Perplexity agent without rate limiting"""
+    agent = create_perplexity_agent(use_fast_research, max_tokens)
+
+    loop = asyncio.get_running_loop()
+    if on_chunk is None:
+        response = await loop.run_in_executor(_agent_executor(), agent.run, prompt)
+        if response and getattr(response, "status", None) == "ERROR":
+            # agno reports provider failures as an errored run instead of raising
+            logger.error(f"Perplexity request failed: {response.content}")
+            return ""
+        return str(response.content) if response and response.content else ""
+
+    # agno streams through a blocking iterator, so drain it on a worker thread and
+    # hand every chunk back to the event loop, where Streamlit calls are safe
+    chunks = asyncio.Queue()
+    failed = []
+    # Set when the caller gives up on the response, so the worker stops reading it
+    abandoned = threading.Event()
+
+    def deliver(text):
+        try:
+            loop.call_soon_threadsafe(chunks.put_nowait, text)
+        except RuntimeError:
+            # The event loop has already finished; nobody is waiting for the rest
+            abandoned.set()
 
-    if use_cache and os.path.exists(cache_file):
+    def stream_response():
         try:
-            with open(cache_file, "r") as f:
-                cache = json.load(f)
-                if cache_key in cache:
-                    logger.info("Using cached metadata")
-                    return cache[cache_key]
-        except Exception as e:
-            logger.error(f"Error reading cache: {str(e)}")
+            for chunk in agent.run(prompt, stream=True):
+                if abandoned.is_set():
+                    break
+                if getattr(chunk, "event", None) == "RunError":
+                    failed.append(chunk.content)
+                    break
+                if chunk and chunk.content:
+                    deliver(str(chunk.content))
+        finally:
+            deliver(None)
+
+    worker = loop.run_in_executor(_agent_executor(), stream_response)
+    parts = []
+    try:
+        while (text := await chunks.get()) is not None:
+            parts.append(text)
+            on_chunk(text)
+    except asyncio.CancelledError:
+        abandoned.set()
+        worker.cancel()
+        raise
+
+    # Surface any error raised while streaming
+    await worker
+    if failed:
+        logger.error(f"Perplexity request failed: {failed[0]}")
+        return ""
+    return "".join(parts)
 
-    # Create a new agent
-    agent = create_perplexity_agent(use_fast_research)
+# Function to run a prompt through the agent within the rate limits
+async def run_agent(prompt, use_fast_research=False, on_chunk=None):
+    """Run a prompt through a Perplexity agent and return the response text"""
+    prompt, max_tokens = fit_prompt_to_budget(prompt)
+    async with perplexity_limiter().acquire(estimate_tokens(prompt)):
+        return await _run_agent_once(prompt, use_fast_research, on_chunk, max_tokens)
 
-    # Prepare metadata prompt
-    prompt = f"""
+# Prompt template for guideline metadata
+_METADATA_PROMPT_TMPL = """
 # Guideline Research Task: {topic} - Metadata and Executive Summary
 
 ## Background Context
@@ -121,66 +694,31 @@ Format your response as follows:
 6-25. [New evidence citations in standard academic format]
 """
 
+# Function to research guideline metadata
+@disk_cached(lambda topic, use_fast_research, **_: research_cache_key(topic, "metadata", use_fast_research=use_fast_research))
+async def research_guideline_metadata(topic, use_fast_research=False, use_cache=True, on_chunk=None):
+    """Research guideline metadata and executive summary"""
+    # Prepare metadata prompt
+    prompt = _METADATA_PROMPT_TMPL.format(topic=topic)
+
     try:
         # Run the agent
         logger.info(f"Researching metadata for {topic} using {'fast' if use_fast_research else 'deep'} research...")
-        response = agent.run(prompt)
-
-        # Process response
-        if response and response.content:
-            result = str(response.content)
-            logger.info(f"Generated metadata of length: {len(result)}")
-
-            # Cache the result
-            if use_cache:
-                try:
-                    cache = {}
-                    if os.path.exists(cache_file):
-                        with open(cache_file, "r") as f:
-                            cache = json.load(f)
-                    cache[cache_key] = result
-                    with open(cache_file, "w") as f:
-                        json.dump(cache, f)
-                except Exception as e:
-                    logger.error(f"Error writing to cache: {str(e)}")
-
-            return result
-        else:
-            logger.error(f"No metadata received")
-            return "# Guidelines Update\n\n## Failed to generate metadata.\n\nPlease check the logs for details."
+        result = await run_agent(prompt, use_fast_research, on_chunk)
     except Exception as e:
         logger.error(f"Error researching metadata: {str(e)}")
-        return f"# Guidelines Update\n\n## Error\n\nAn error occurred while researching metadata: {str(e)}"
-
-# Function to research guideline section
-def research_guideline_section(topic, section, use_fast_research=False, use_cache=True):
-    """Research a specific section of the guidelines"""
-    # Create tmp directory if it doesn't exist
-    os.makedirs("tmp", exist_ok=True)
-
-    # Create cache if needed
-    cache_file = "tmp/guidelines_cache.json"
-    cache_key = f"{topic}_{section}_{datetime.datetime.now().strftime('%Y-%m-%d')}"
-    
-    # Add research mode to cache key
-    research_mode = "fast" if use_fast_research else "deep"
-    cache_key = f"{cache_key}_{research_mode}"
+        raise ResearchError(f"# Guidelines Update\n\n## Error\n\nAn error occurred while researching metadata: {str(e)}") from e
 
-    if use_cache and os.path.exists(cache_file):
-        try:
-            with open(cache_file, "r") as f:
-                cache = json.load(f)
-                if cache_key in cache:
-                    logger.info(f"Using cached result for {section}")
-                    return cache[cache_key]
-        except Exception as e:
-            logger.error(f"Error reading cache: {str(e)}")
+    # Process response
+    if not result:
+        logger.error(f"No metadata received")
+        raise ResearchError("# Guidelines Update\n\n## Failed to generate metadata.\n\nPlease check the logs for details.")
 
-    # Create a new agent
-    agent = create_perplexity_agent(use_fast_research)
+    logger.info(f"Generated metadata of length: {len(result)}")
+    return result
 
-    # Section-specific prompt
-    prompt = f"""
+# Prompt template for a guideline section
+_SECTION_PROMPT_TMPL = """
 # Guideline Research Task: {topic} - {section} Section
 
 ## Research Context
@@ -247,66 +785,110 @@ Use this exact format:
 - [Resource implications]
 """
 
+# Function to build the research prompt for a guideline section
+def build_section_prompt(topic, section):
+    """Build the research prompt for a specific section of the guidelines"""
+    return _SECTION_PROMPT_TMPL.format(topic=topic, section=section)
+
+# Function to research guideline section
+@disk_cached(lambda topic, section, use_fast_research, **_: research_cache_key(topic, section, use_fast_research=use_fast_research))
+async def research_guideline_section(topic, section, use_fast_research=False, use_cache=True, on_chunk=None):
+    """Research a specific section of the guidelines"""
+    # Section-specific prompt
+    prompt = build_section_prompt(topic, section)
+
     try:
         # Run the agent
         logger.info(f"Researching {section} for {topic} using {'fast' if use_fast_research else 'deep'} research...")
-        response = agent.run(prompt)
-
-        # Check response
-        if response and response.content:
-            result = str(response.content)
-            logger.info(f"Generated content for {section} of length: {len(result)}")
-
-            # Cache the result
-            if use_cache:
-                try:
-                    cache = {}
-                    if os.path.exists(cache_file):
-                        with open(cache_file, "r") as f:
-                            cache = json.load(f)
-                    cache[cache_key] = result
-                    with open(cache_file, "w") as f:
-                        json.dump(cache, f)
-                except Exception as e:
-                    logger.error(f"Error writing to cache: {str(e)}")
-
-            return result
-        else:
-            logger.error(f"No content received for {section}")
-            return f"### {section}\n\nFailed to generate content for this section. Please check the logs for details."
+        result = await run_agent(prompt, use_fast_research, on_chunk)
     except Exception as e:
         logger.error(f"Error researching {section}: {str(e)}")
-        return f"### {section}\n\nAn error occurred while researching this section: {str(e)}"
+        raise ResearchError(f"### {section}\n\nAn error occurred while researching this section: {str(e)}") from e
 
-# Function for research new recommendations
-def research_new_recommendations(topic, use_fast_research=False, use_cache=True):
-    """Research completely new recommendations"""
-    # Create tmp directory if it doesn't exist
-    os.makedirs("tmp", exist_ok=True)
-
-    # Create cache if needed
-    cache_file = "tmp/guidelines_cache.json"
-    cache_key = f"{topic}_new_recommendations_{datetime.datetime.now().strftime('%Y-%m-%d')}"
-    
-    # Add research mode to cache key
-    research_mode = "fast" if use_fast_research else "deep"
-    cache_key = f"{cache_key}_{research_mode}"
-
-    if use_cache and os.path.exists(cache_file):
-        try:
-            with open(cache_file, "r") as f:
-                cache = json.load(f)
-                if cache_key in cache:
-                    logger.info(f"Using cached new recommendations")
-                    return cache[cache_key]
-        except Exception as e:
-            logger.error(f"Error reading cache: {str(e)}")
-
-    # Create a new agent
-    agent = create_perplexity_agent(use_fast_research)
+    # Process response
+    if not result:
+        logger.error(f"No content received for {section}")
+        raise ResearchError(f"### {section}\n\nFailed to generate content for this section. Please check the logs for details.")
+
+    logger.info(f"Generated content for {section} of length: {len(result)}")
+    return result
+
+# Tasks left running after their caller returned; holding them keeps them from being garbage collected
+_background_tasks = set()
+
+def _forget_background_task(task):
+    _background_tasks.discard(task)
+    # Retrieve the outcome so a failure is not reported as never retrieved
+    if not task.cancelled():
+        task.exception()
+
+# Function to research a section with deep research, falling back to fast research
+async def research_guideline_section_speculative(topic, section, use_cache=True, on_chunk=None):
+    """Race fast and deep research for a section and keep the deep result if it succeeds within budget"""
+    # A cached deep result needs no race, and no fast request
+    if use_cache:
+        cached = cached_result(research_cache_key(topic, section, use_fast_research=False), CACHE_MAX_AGE)
+        if cached is not None:
+            logger.info(f"Using cached deep research for {section}")
+            return cached
+
+    # Both calls go through the cached researcher, so each mode is stored under its own key;
+    # the strict variant raises on failure, so a failed deep run can fall back to the fast result
+    fast_task = asyncio.create_task(research_guideline_section.strict(topic, section, True, use_cache))
+    deep_task = asyncio.create_task(research_guideline_section.strict(topic, section, False, use_cache, on_chunk))
+
+    done, _ = await asyncio.wait({deep_task}, timeout=DEEP_RESEARCH_BUDGET)
+    if deep_task in done and deep_task.exception() is None:
+        logger.info(f"Deep research for {section} finished within budget")
+        # Leave fast research running so it is cached if it finishes before the workflow ends
+        _background_tasks.add(fast_task)
+        fast_task.add_done_callback(_forget_background_task)
+        return deep_task.result()
+
+    if deep_task in done:
+        logger.info(f"Deep research for {section} failed, using fast research")
+    else:
+        logger.info(f"Deep research for {section} exceeded {DEEP_RESEARCH_BUDGET}s, using fast research")
+        deep_task.cancel()
 
-    # Prepare new recommendations prompt
-    prompt = f"""
+    try:
+        return await fast_task
+    except ResearchError as e:
+        # Both modes failed; show the deep research error if there is one
+        if deep_task in done:
+            return str(deep_task.exception())
+        return str(e)
+
+# Function to run several independent prompts together
+async def batch_agent_run(prompts, use_fast_research=False, on_chunks=None):
+    """Run independent prompts concurrently and return the responses in prompt order"""
+    # Perplexity's chat completions endpoint accepts a single conversation per
+    # request, so fan the prompts out concurrently instead of one after another
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    on_chunks = on_chunks or [None] * len(prompts)
+
+    async def run_prompt(prompt, on_chunk):
+        async with semaphore:
+            return await run_agent(prompt, use_fast_research, on_chunk)
+
+    return await asyncio.gather(*[run_prompt(prompt, on_chunk) for prompt, on_chunk in zip(prompts, on_chunks)], return_exceptions=True)
+
+# Function to research several guideline sections in one batch
+async def research_guideline_sections(topic, sections, use_fast_research=False, use_cache=True, on_section_chunk=None):
+    """Research several sections of the guidelines concurrently and return the results in section order"""
+    # Each section goes through the cached researcher, so caching and error text live in one place
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    logger.info(f"Researching {len(sections)} sections for {topic} using {'fast' if use_fast_research else 'deep'} research...")
+
+    async def research_section(section):
+        on_chunk = functools.partial(on_section_chunk, section) if on_section_chunk else None
+        async with semaphore:
+            return await research_guideline_section(topic, section, use_fast_research, use_cache, on_chunk)
+
+    return await asyncio.gather(*[research_section(section) for section in sections])
+
+# Prompt template for new recommendations
+_NEW_RECS_PROMPT_TMPL = """
 # Guideline Research Task: {topic} - Completely New Recommendations
 
 ## Research Context
@@ -371,69 +953,45 @@ Use this exact format:
 [Continue for 4-6 total new recommendations]
 """
 
+# Function for research new recommendations
+@disk_cached(lambda topic, use_fast_research, **_: research_cache_key(topic, "new_recommendations", use_fast_research=use_fast_research))
+async def research_new_recommendations(topic, use_fast_research=False, use_cache=True, on_chunk=None):
+    """Research completely new recommendations"""
+    # Prepare new recommendations prompt
+    prompt = _NEW_RECS_PROMPT_TMPL.format(topic=topic)
+
     try:
         # Run the agent
         logger.info(f"Researching new recommendations for {topic} using {'fast' if use_fast_research else 'deep'} research...")
-        response = agent.run(prompt)
-
-        # Process response
-        if response and response.content:
-            result = str(response.content)
-            logger.info(f"Generated new recommendations of length: {len(result)}")
-
-            # Cache the result
-            if use_cache:
-                try:
-                    cache = {}
-                    if os.path.exists(cache_file):
-                        with open(cache_file, "r") as f:
-                            cache = json.load(f)
-                    cache[cache_key] = result
-                    with open(cache_file, "w") as f:
-                        json.dump(cache, f)
-                except Exception as e:
-                    logger.error(f"Error writing to cache: {str(e)}")
-
-            return result
-        else:
-            logger.error(f"No new recommendations received")
-            return "## New Recommendations\n\nFailed to generate new recommendations. Please check the logs for details."
+        result = await run_agent(prompt, use_fast_research, on_chunk)
     except Exception as e:
         logger.error(f"Error researching new recommendations: {str(e)}")
-        return f"## New Recommendations\n\nAn error occurred while researching new recommendations: {str(e)}"
-
-# Function for chunked section research
-def research_section_chunked(topic, section, use_fast_research=False, use_cache=True):
-    """Research a section in chunks to prevent truncation"""
-    # Create tmp directory if it doesn't exist
-    os.makedirs("tmp", exist_ok=True)
+        raise ResearchError(f"## New Recommendations\n\nAn error occurred while researching new recommendations: {str(e)}") from e
 
-    # Create cache if needed
-    cache_file = "tmp/guidelines_cache.json"
-    cache_key = f"{topic}_{section}_chunked_{datetime.datetime.now().strftime('%Y-%m-%d')}"
-    
-    # Add research mode to cache key
-    research_mode = "fast" if use_fast_research else "deep"
-    cache_key = f"{cache_key}_{research_mode}"
+    # Process response
+    if not result:
+        logger.error(f"No new recommendations received")
+        raise ResearchError("## New Recommendations\n\nFailed to generate new recommendations. Please check the logs for details.")
 
-    if use_cache and os.path.exists(cache_file):
-        try:
-            with open(cache_file, "r") as f:
-                cache = json.load(f)
-                if cache_key in cache:
-                    logger.info(f"Using cached chunked result for {section}")
-                    return cache[cache_key]
-        except Exception as e:
-            logger.error(f"Error reading cache: {str(e)}")
+    logger.info(f"Generated new recommendations of length: {len(result)}")
+    return result
 
-    # Step 1: First get the original guideline recommendations for this section
-    original_recommendations = research_original_recommendations(topic, section, use_fast_research)
+# Function for chunked section research
+@disk_cached(lambda topic, section, use_fast_research, **_: research_cache_key(topic, section, "chunked", use_fast_research=use_fast_research))
+async def research_section_chunked(topic, section, use_fast_research=False, use_cache=True):
+    """Research a section in chunks to prevent truncation"""
+    try:
+        # Step 1: First get the original guideline recommendations for this section
+        original_recommendations = await research_original_recommendations(topic, section, use_fast_research)
 
-    # Step 2: Research new evidence for each recommendation
-    evidence_analysis = research_section_evidence(topic, section, original_recommendations, use_fast_research)
+        # Step 2: Research new evidence for each recommendation
+        evidence_analysis = await research_section_evidence(topic, section, original_recommendations, use_fast_research)
 
-    # Step 3: Generate the updated recommendations with rationale
-    updated_recommendations = generate_updated_recommendations(topic, section, original_recommendations, evidence_analysis, use_fast_research)
+        # Step 3: Generate the updated recommendations with rationale
+        updated_recommendations = await generate_updated_recommendations(topic, section, original_recommendations, evidence_analysis, use_fast_research)
+    except ResearchError as e:
+        # A failed step fails the whole section, so no partial section is cached
+        raise ResearchError(f"### {section}\n\n{str(e)}") from e
 
     # Combine all parts
     full_section = f"""
@@ -442,28 +1000,10 @@ def research_section_chunked(topic, section, use_fast_research=False, use_cache=
 {updated_recommendations}
     """
 
-    # Cache the result
-    if use_cache:
-        try:
-            cache = {}
-            if os.path.exists(cache_file):
-                with open(cache_file, "r") as f:
-                    cache = json.load(f)
-            cache[cache_key] = full_section
-            with open(cache_file, "w") as f:
-                json.dump(cache, f)
-        except Exception as e:
-            logger.error(f"Error writing to cache: {str(e)}")
-
     return full_section
 
-def research_original_recommendations(topic, section, use_fast_research=False):
-    """Research just the original recommendations for a section"""
-    # Create a new agent
-    agent = create_perplexity_agent(use_fast_research)
-
-    # Focused prompt to get just the original recommendations
-    prompt = f"""
+# Prompt template for original recommendations
+_ORIGINAL_RECS_TMPL = """
 # Research Task: Original {topic} Guidelines for {section}
 
 ## Task Description
@@ -487,26 +1027,25 @@ Example:
 2. "Second recommendation text" [Grade A, 2019]
 """
 
+async def research_original_recommendations(topic, section, use_fast_research=False):
+    """Research just the original recommendations for a section"""
+    # Focused prompt to get just the original recommendations
+    prompt = _ORIGINAL_RECS_TMPL.format(topic=topic, section=section)
+
     # Run the agent
     logger.info(f"Researching original recommendations for {section} using {'fast' if use_fast_research else 'deep'} research...")
-    response = agent.run(prompt)
+    result = await run_agent(prompt, use_fast_research)
 
     # Process response
-    if response and response.content:
-        result = str(response.content)
+    if result:
         logger.info(f"Retrieved original recommendations: {len(result)} chars")
         return result
     else:
         logger.error(f"Failed to retrieve original recommendations for {section}")
-        return f"1. \"No specific recommendations found for {section}\" [Grade Unknown, Unknown date]"
+        raise ResearchError("Failed to retrieve the original recommendations for this section. Please check the logs for details.")
 
-def research_section_evidence(topic, section, original_recommendations, use_fast_research=False):
-    """Research new evidence for recommendations"""
-    # Create a new agent
-    agent = create_perplexity_agent(use_fast_research)
-
-    # Focused prompt for evidence analysis
-    prompt = f"""
+# Prompt template for section evidence
+_EVIDENCE_TMPL = """
 # Research Task: New Evidence Analysis for {topic} - {section}
 
 ## Original Recommendations
@@ -544,26 +1083,27 @@ Format your analysis for each recommendation:
 [Same format]
 """
 
+async def research_section_evidence(topic, section, original_recommendations, use_fast_research=False):
+    """Research new evidence for recommendations"""
+    # Focused prompt for evidence analysis
+    prompt = format_prompt_within_budget(
+        _EVIDENCE_TMPL, {"original_recommendations": original_recommendations}, topic=topic, section=section
+    )
+
     # Run the agent
     logger.info(f"Researching new evidence for {section} using {'fast' if use_fast_research else 'deep'} research...")
-    response = agent.run(prompt)
+    result = await run_agent(prompt, use_fast_research)
 
     # Process response
-    if response and response.content:
-        result = str(response.content)
+    if result:
         logger.info(f"Retrieved evidence analysis: {len(result)} chars")
         return result
     else:
         logger.error(f"Failed to retrieve evidence analysis for {section}")
-        return f"### Evidence Analysis\nNo substantial new evidence was found that would change the original recommendations."
+        raise ResearchError("Failed to research new evidence for this section. Please check the logs for details.")
 
-def generate_updated_recommendations(topic, section, original_recommendations, evidence_analysis, use_fast_research=False):
-    """Generate updated recommendations based on original recs and new evidence"""
-    # Create a new agent
-    agent = create_perplexity_agent(use_fast_research)
-
-    # Focused prompt for final recommendation updates
-    prompt = f"""
+# Prompt template for updated recommendations
+_UPDATED_TMPL = """
 # Task: Generate Updated Recommendations for {topic} - {section}
 
 ## Original Recommendations
@@ -602,59 +1142,48 @@ Based on the original recommendations and new evidence analysis, create a side-b
 [Repeat for each recommendation]
 """
 
+async def generate_updated_recommendations(topic, section, original_recommendations, evidence_analysis, use_fast_research=False):
+    """Generate updated recommendations based on original recs and new evidence"""
+    # Focused prompt for final recommendation updates
+    prompt = format_prompt_within_budget(
+        _UPDATED_TMPL,
+        {"original_recommendations": original_recommendations, "evidence_analysis": evidence_analysis},
+        topic=topic, section=section,
+    )
+
     # Run the agent
     logger.info(f"Generating updated recommendations for {section} using {'fast' if use_fast_research else 'deep'} research...")
-    response = agent.run(prompt)
+    result = await run_agent(prompt, use_fast_research)
 
     # Process response
-    if response and response.content:
-        result = str(response.content)
+    if result:
         logger.info(f"Generated updated recommendations: {len(result)} chars")
         return result
     else:
         logger.error(f"Failed to generate updated recommendations for {section}")
-        return f"No updates to {section} recommendations could be generated based on current evidence."
+        raise ResearchError("Failed to generate updated recommendations for this section. Please check the logs for details.")
+
+# Seconds a researched gap area stays cached
+GAP_CACHE_MAX_AGE = 86400
 
 # Function for chunked new recommendations
-def research_new_recommendations_chunked(topic, use_fast_research=False, use_cache=True):
+# The result embeds the gap analyses, so it expires with them
+@disk_cached(lambda topic, use_fast_research, **_: research_cache_key(topic, "new_recs_chunked", use_fast_research=use_fast_research),
+             max_age=GAP_CACHE_MAX_AGE)
+async def research_new_recommendations_chunked(topic, use_fast_research=False, use_cache=True):
     """Research completely new recommendations in chunks"""
-    # Create tmp directory if it doesn't exist
-    os.makedirs("tmp", exist_ok=True)
-
-    # Create cache if needed
-    cache_file = "tmp/guidelines_cache.json"
-    cache_key = f"{topic}_new_recs_chunked_{datetime.datetime.now().strftime('%Y-%m-%d')}"
-    
-    # Add research mode to cache key
-    research_mode = "fast" if use_fast_research else "deep"
-    cache_key = f"{cache_key}_{research_mode}"
-
-    if use_cache and os.path.exists(cache_file):
-        try:
-            with open(cache_file, "r") as f:
-                cache = json.load(f)
-                if cache_key in cache:
-                    logger.info(f"Using cached chunked new recommendations")
-                    return cache[cache_key]
-        except Exception as e:
-            logger.error(f"Error reading cache: {str(e)}")
-
     # Step 1: Identify gaps in current guidelines
-    guideline_gaps = identify_guideline_gaps(topic, use_fast_research)
+    guideline_gaps = await identify_guideline_gaps(topic, use_fast_research)
 
     # Step 2: Research each gap area
-    gap_analyses = []
-
     # Extract gap areas from the response
     gap_areas = extract_gap_areas(guideline_gaps)
 
-    # Research each gap area
-    for gap in gap_areas:
-        gap_analysis = research_single_gap(topic, gap, use_fast_research)
-        gap_analyses.append(gap_analysis)
+    # Gap areas are independent, so research them concurrently
+    gap_analyses = await research_gaps_batched(topic, gap_areas, use_fast_research, use_cache)
 
-    # Step 3: Compile all new recommendations
-    all_new_recommendations = "\n\n".join(gap_analyses)
+    # Step 3: Compile all new recommendations; failed areas come back as ResearchError
+    all_new_recommendations = "\n\n".join(str(gap_analysis) for gap_analysis in gap_analyses)
 
     # Format the final output
     new_recommendations = f"""
@@ -663,28 +1192,14 @@ def research_new_recommendations_chunked(topic, use_fast_research=False, use_cac
 {all_new_recommendations}
     """
 
-    # Cache the result
-    if use_cache:
-        try:
-            cache = {}
-            if os.path.exists(cache_file):
-                with open(cache_file, "r") as f:
-                    cache = json.load(f)
-            cache[cache_key] = new_recommendations
-            with open(cache_file, "w") as f:
-                json.dump(cache, f)
-        except Exception as e:
-            logger.error(f"Error writing to cache: {str(e)}")
+    if any(isinstance(gap_analysis, ResearchError) for gap_analysis in gap_analyses):
+        # Show what was researched, but keep the fallback text of failed areas out of the cache
+        raise ResearchError(new_recommendations)
 
     return new_recommendations
 
-def identify_guideline_gaps(topic, use_fast_research=False):
-    """Identify gaps in current guidelines that need new recommendations"""
-    # Create a new agent
-    agent = create_perplexity_agent(use_fast_research)
-
-    # Focused prompt for gap identification
-    prompt = f"""
+# Prompt template for guideline gaps
+_GAPS_TMPL = """
 # Research Task: Identify Gaps in Current {topic} Guidelines
 
 ## Task Description
@@ -715,32 +1230,28 @@ List 3-5 specific gap areas in this format:
 [Continue for all identified gaps]
 """
 
+async def identify_guideline_gaps(topic, use_fast_research=False):
+    """Identify gaps in current guidelines that need new recommendations"""
+    # Focused prompt for gap identification
+    prompt = _GAPS_TMPL.format(topic=topic)
+
     # Run the agent
     logger.info(f"Identifying gaps in current {topic} guidelines using {'fast' if use_fast_research else 'deep'} research...")
-    response = agent.run(prompt)
+    result = await run_agent(prompt, use_fast_research)
 
     # Process response
-    if response and response.content:
-        result = str(response.content)
+    if result:
         logger.info(f"Identified guideline gaps: {len(result)} chars")
         return result
     else:
         logger.error(f"Failed to identify guideline gaps for {topic}")
-        return "### Gap Areas in Current Guidelines\n\n1. **Implementation Guidance**\n   - Why this is a gap: Current guidelines lack specific implementation strategies\n   - Clinical importance: Clinicians need practical guidance for real-world application"
+        raise ResearchError("## New Recommendations\n\nFailed to identify gaps in the current guidelines. Please check the logs for details.")
 
 def extract_gap_areas(gap_analysis):
     """Extract gap areas from the gap analysis text"""
-    # Simple extraction using regex
-    # Look for markdown headings or bold text patterns
-    gap_areas = []
-
-    # Try to find bold text pattern first
-    bold_pattern = r'\*\*([^*]+)\*\*'
-    matches = re.findall(bold_pattern, gap_analysis)
-
-    if matches:
-        # Filter out any that don't look like gap areas (too short or common headers)
-        gap_areas = [match for match in matches if len(match) > 5 and "Gap Area" not in match]
+    # Simple extraction using regex on bold text patterns
+    # Filter out any that don't look like gap areas (too short or common headers)
+    gap_areas = [match for match in _BOLD_RE.findall(gap_analysis) if len(match) > 5 and "Gap Area" not in match]
 
     # If we couldn't find any, or found too few, return default areas
     if len(gap_areas) < 2:
@@ -752,13 +1263,8 @@ def extract_gap_areas(gap_analysis):
 
     return gap_areas[:5]  # Limit to 5 areas
 
-def research_single_gap(topic, gap_area, use_fast_research=False):
-    """Research a single gap area to develop new recommendations"""
-    # Create a new agent
-    agent = create_perplexity_agent(use_fast_research)
-
-    # Focused prompt for single gap research
-    prompt = f"""
+# Prompt template for a single gap area
+_SINGLE_GAP_TMPL = """
 # Research Task: Develop New {topic} Recommendations for {gap_area}
 
 ## Task Description
@@ -787,18 +1293,143 @@ Format your new recommendations as:
     [Same format as above]
 """
 
+# Function to build the cache key for a single gap area
+def gap_cache_key(topic, gap_area, use_fast_research=False):
+    """Build the cache key shared by single and batched gap research"""
+    return research_cache_key(topic, "gap", gap_area, use_fast_research=use_fast_research)
+
+# Function to research a single gap area
+@disk_cached(lambda topic, gap_area, use_fast_research, **_: gap_cache_key(topic, gap_area, use_fast_research), max_age=GAP_CACHE_MAX_AGE)
+async def research_single_gap(topic, gap_area, use_fast_research=False, use_cache=True):
+    """Research a single gap area to develop new recommendations"""
+    # Focused prompt for single gap research
+    prompt = _SINGLE_GAP_TMPL.format(topic=topic, gap_area=gap_area)
+
     # Run the agent
     logger.info(f"Researching new recommendations for {gap_area} using {'fast' if use_fast_research else 'deep'} research...")
-    response = agent.run(prompt)
+    result = await run_agent(prompt, use_fast_research)
 
     # Process response
-    if response and response.content:
-        result = str(response.content)
-        logger.info(f"Generated new recommendations for {gap_area}: {len(result)} chars")
-        return result
-    else:
+    if not result:
         logger.error(f"Failed to generate new recommendations for {gap_area}")
-        return f"### {gap_area}\n\nInsufficient evidence is currently available to make formal recommendations in this area."
+        raise ResearchError(f"### {gap_area}\n\nInsufficient evidence is currently available to make formal recommendations in this area.")
+
+    logger.info(f"Generated new recommendations for {gap_area}: {len(result)} chars")
+    return result
+
+# Function to research every gap area concurrently
+async def research_all_gaps(topic, gap_areas, use_fast_research=False, use_cache=True):
+    """Research all gap areas concurrently and return the analyses in gap order, with a ResearchError for each failed area"""
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def research_gap(gap_area):
+        async with semaphore:
+            try:
+                return await research_single_gap.strict(topic, gap_area, use_fast_research, use_cache)
+            except ResearchError as e:
+                return e
+            except Exception as e:
+                # One failed gap shouldn't cancel the others in the task group
+                logger.error(f"Error researching {gap_area}: {str(e)}")
+                return ResearchError(f"### {gap_area}\n\nAn error occurred while researching this area: {str(e)}")
+
+    async with asyncio.TaskGroup() as tg:
+        tasks = [tg.create_task(research_gap(gap_area)) for gap_area in gap_areas]
+    return [task.result() for task in tasks]
+
+# Prompt template for several gap areas researched in one request
+_GAP_BATCH_TMPL = """
+# Research Task: Develop New {topic} Recommendations for Several Gap Areas
+
+## Task Description
+Create 1-2 new evidence-based recommendations for {topic} addressing each of these gap areas:
+{gap_list}
+
+## Research Instructions
+For each gap area:
+1. Research recent high-quality evidence related to the gap area in {topic}
+2. Identify specific clinical questions that need guidance
+3. Develop precise, actionable recommendations that:
+    - Address a specific clinical scenario
+    - Are based on best available evidence
+    - Include appropriate evidence grading
+    - Provide implementation guidance
+
+## Output Format
+Write one section per gap area, in the order listed above. Start each section with a level-3 heading
+that repeats the gap area name exactly, and do not use level-3 headings anywhere else:
+
+### [Gap area name]
+
+1. **"[Exact recommendation text]"** [Suggested Grade: X]
+    - **Rationale**: [Evidence-based justification with 2-3 key studies]
+    - **Implementation**: [Practical guidance for clinicians]
+    - **Special Considerations**: [Important caveats or subpopulations]
+
+2. **"[Second recommendation if applicable]"** [Suggested Grade: X]
+    [Same format as above]
+
+After the last section, end the response with a line containing only {end_marker}
+"""
+
+# Line closing a complete batched gap response; a response cut off at max_tokens never reaches it
+_GAP_BATCH_END = "END OF GAP ANALYSES"
+
+# Function to split a batched gap response back into per-gap blocks
+def split_gap_sections(response, gap_areas):
+    """Split a batched gap response into one block per gap area, in gap order, with None for missing areas"""
+    body, end_marker, _ = response.rpartition(_GAP_BATCH_END)
+    blocks = ["### " + block.strip() for block in _H3_SPLIT_RE.split(body if end_marker else response)[1:]]
+    if not end_marker and blocks:
+        # The response was truncated, so its last block is incomplete and must not be cached
+        heading = blocks.pop().partition("\n")[0]
+        logger.warning(f"Batched gap response was cut off, dropping its last block: {heading}")
+    by_heading = {block.split("\n", 1)[0][4:].strip(" *").lower(): block for block in blocks}
+    if all(gap_area.lower() in by_heading for gap_area in gap_areas):
+        return [by_heading[gap_area.lower()] for gap_area in gap_areas]
+    # Fall back to position when the model paraphrased the headings but kept one block per area
+    if len(blocks) == len(gap_areas):
+        return blocks
+    return [by_heading.get(gap_area.lower()) for gap_area in gap_areas]
+
+# Function to research gap areas a few at a time in shared requests
+async def research_gaps_batched(topic, gap_areas, use_fast_research=False, use_cache=True, batch_size=3):
+    """Research gap areas with one request per batch_size areas and return the analyses in gap order, with a ResearchError for each failed area"""
+    results = {}
+    if use_cache:
+        for gap_area in gap_areas:
+            cached = cached_result(gap_cache_key(topic, gap_area, use_fast_research), GAP_CACHE_MAX_AGE)
+            if cached is not None:
+                logger.info(f"Using cached result for gap {gap_area}")
+                results[gap_area] = cached
+
+    pending = [gap_area for gap_area in gap_areas if gap_area not in results]
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    prompts = [
+        _GAP_BATCH_TMPL.format(topic=topic, gap_list="\n".join(f"- {gap_area}" for gap_area in batch), end_marker=_GAP_BATCH_END)
+        for batch in batches
+    ]
+    logger.info(f"Researching {len(pending)} gap areas in {len(batches)} requests using {'fast' if use_fast_research else 'deep'} research...")
+    responses = await batch_agent_run(prompts, use_fast_research)
+
+    for batch, response in zip(batches, responses):
+        if isinstance(response, Exception) or not response:
+            logger.error(f"Batched gap research failed for {', '.join(batch)}: {str(response)}")
+            continue
+        for gap_area, block in zip(batch, split_gap_sections(response, batch)):
+            if block is None:
+                continue
+            results[gap_area] = block
+            if use_cache:
+                store_result(gap_cache_key(topic, gap_area, use_fast_research), block)
+
+    # Areas missing from a batched response are researched one at a time
+    missing = [gap_area for gap_area in gap_areas if gap_area not in results]
+    if missing:
+        logger.warning(f"Researching {len(missing)} gap areas individually: {', '.join(missing)}")
+        results.update(zip(missing, await research_all_gaps(topic, missing, use_fast_research, use_cache)))
+
+    return [results[gap_area] for gap_area in gap_areas]
 
 def extract_key_points(metadata_result, sections_summary):
     """Extract key points from previous results to ground the conclusion"""
@@ -806,56 +1437,28 @@ def extract_key_points(metadata_result, sections_summary):
     key_points = "Key points from previous sections:\n"
 
     # Extract publication date and org if available
-    pub_date_match = re.search(r'Original Publication: (\w+ \d{4}) by ([^|]+)', metadata_result)
+    pub_date_match = _PUB_DATE_RE.search(metadata_result)
     if pub_date_match:
         key_points += f"- Original guidelines published {pub_date_match.group(1)} by {pub_date_match.group(2).strip()}\n"
 
     # Extract section names
-    section_matches = re.findall(r'### ([^\n]+)', sections_summary)
+    section_matches = parse_structure(sections_summary)["h3_titles"]
     if section_matches:
         key_points += "- Updated sections include: " + ", ".join(section_matches) + "\n"
 
-    # Extract boldface changes
-    bold_changes = re.findall(r'\*\*([^*]+)\*\*', sections_summary)
+    # Extract boldface changes; past 10 only the count is needed, so the rest are counted without being kept
+    bold_matches = _BOLD_RE.finditer(sections_summary)
+    bold_changes = [match.group(1) for match in itertools.islice(bold_matches, 11)]
     if bold_changes and len(bold_changes) <= 10:
         key_points += "- Key changes include: " + ", ".join(bold_changes[:5]) + "\n"
     elif bold_changes:
-        key_points += f"- Approximately {len(bold_changes)} significant changes have been made across all sections\n"
+        bold_count = len(bold_changes) + sum(1 for _ in bold_matches)
+        key_points += f"- Approximately {bold_count} significant changes have been made across all sections\n"
 
     return key_points
 
-# Function for comprehensive conclusion
-def research_comprehensive_conclusion(topic, metadata_result, sections_summary, use_fast_research=False, use_cache=True):
-    """Create a comprehensive conclusion to ensure completeness"""
-    # Create tmp directory if it doesn't exist
-    os.makedirs("tmp", exist_ok=True)
-
-    # Create cache if needed
-    cache_file = "tmp/guidelines_cache.json"
-    cache_key = f"{topic}_conclusion_{datetime.datetime.now().strftime('%Y-%m-%d')}"
-    
-    # Add research mode to cache key
-    research_mode = "fast" if use_fast_research else "deep"
-    cache_key = f"{cache_key}_{research_mode}"
-
-    if use_cache and os.path.exists(cache_file):
-        try:
-            with open(cache_file, "r") as f:
-                cache = json.load(f)
-                if cache_key in cache:
-                    logger.info("Using cached conclusion")
-                    return cache[cache_key]
-        except Exception as e:
-            logger.error(f"Error reading cache: {str(e)}")
-
-    # Create a new agent
-    agent = create_perplexity_agent(use_fast_research)
-
-    # Extract key points to ground the conclusion
-    key_points = extract_key_points(metadata_result, sections_summary)
-
-    # Focused prompt for conclusion
-    prompt = f"""
+# Prompt template for the comprehensive conclusion
+_CONCLUSION_TMPL = """
 # Task: Create Comprehensive Conclusion for {topic} Guidelines
 
 ## Key Points from Previous Sections
@@ -916,69 +1519,35 @@ Format your response as:
 [Standard statement about conflicts of interest]
 """
 
+# Function for comprehensive conclusion
+@disk_cached(lambda topic, metadata_result, sections_summary, use_fast_research, **_: research_cache_key(
+    topic, "conclusion", content_hash(metadata_result, sections_summary), use_fast_research=use_fast_research))
+async def research_comprehensive_conclusion(topic, metadata_result, sections_summary, use_fast_research=False, use_cache=True, on_chunk=None):
+    """Create a comprehensive conclusion to ensure completeness"""
+    # Extract key points to ground the conclusion
+    key_points = extract_key_points(metadata_result, sections_summary)
+
+    # Focused prompt for conclusion
+    prompt = _CONCLUSION_TMPL.format(topic=topic, key_points=key_points)
+
     try:
         # Run the agent
         logger.info(f"Creating comprehensive conclusion for {topic} using {'fast' if use_fast_research else 'deep'} research...")
-        response = agent.run(prompt)
-
-        # Process response
-        if response and response.content:
-            result = str(response.content)
-            logger.info(f"Generated conclusion: {len(result)} chars")
-
-            # Cache the result
-            if use_cache:
-                try:
-                    cache = {}
-                    if os.path.exists(cache_file):
-                        with open(cache_file, "r") as f:
-                            cache = json.load(f)
-                    cache[cache_key] = result
-                    with open(cache_file, "w") as f:
-                        json.dump(cache, f)
-                except Exception as e:
-                    logger.error(f"Error writing to cache: {str(e)}")
-
-            return result
-        else:
-            logger.error(f"Failed to generate conclusion for {topic}")
-            return "## Conclusion\n\nThis concludes the updated guidelines. Implementation should be tailored to local contexts and resources."
+        result = await run_agent(prompt, use_fast_research, on_chunk)
     except Exception as e:
         logger.error(f"Error researching conclusion: {str(e)}")
-        return f"## Conclusion\n\nAn error occurred while researching the conclusion: {str(e)}"
-
-# Function to adapt guidelines for different contexts
-def generate_context_adaptations(topic, sections_content, use_fast_research=False, use_cache=True):
-    """Generate context-specific adaptations for different healthcare settings"""
-    # Create tmp directory if it doesn't exist
-    os.makedirs("tmp", exist_ok=True)
-
-    # Create cache if needed
-    cache_file = "tmp/guidelines_cache.json"
-    cache_key = f"{topic}_context_adaptations_{datetime.datetime.now().strftime('%Y-%m-%d')}"
-    
-    # Add research mode to cache key
-    research_mode = "fast" if use_fast_research else "deep"
-    cache_key = f"{cache_key}_{research_mode}"
-
-    if use_cache and os.path.exists(cache_file):
-        try:
-            with open(cache_file, "r") as f:
-                cache = json.load(f)
-                if cache_key in cache:
-                    logger.info("Using cached context adaptations")
-                    return cache[cache_key]
-        except Exception as e:
-            logger.error(f"Error reading cache: {str(e)}")
+        raise ResearchError(f"## Conclusion\n\nAn error occurred while researching the conclusion: {str(e)}") from e
 
-    # Create a new agent
-    agent = create_perplexity_agent(use_fast_research)
+    # Process response
+    if not result:
+        logger.error(f"Failed to generate conclusion for {topic}")
+        raise ResearchError("## Conclusion\n\nThis concludes the updated guidelines. Implementation should be tailored to local contexts and resources.")
 
-    # Extract recommendations to adapt
-    recommendations = extract_recommendations(sections_content)
+    logger.info(f"Generated conclusion: {len(result)} chars")
+    return result
 
-    # Prompt for context adaptations
-    prompt = f"""
+# Prompt template for setting-specific adaptations
+_ADAPTATIONS_TMPL = """
 # Task: Generate Setting-Specific Adaptations for {topic} Guidelines
 
 ## Guidelines Overview
@@ -1039,60 +1608,55 @@ Format your response as follows:
 [Follow same format as above]
 """
 
+# Function to adapt guidelines for different contexts
+@disk_cached(lambda topic, sections_content, use_fast_research, **_: research_cache_key(
+    topic, "context_adaptations", content_hash(sections_content), use_fast_research=use_fast_research))
+async def generate_context_adaptations(topic, sections_content, use_fast_research=False, use_cache=True, on_chunk=None):
+    """Generate context-specific adaptations for different healthcare settings"""
+    # Extract recommendations to adapt
+    recommendations = extract_recommendations(sections_content)
+
+    # Prompt for context adaptations
+    prompt = _ADAPTATIONS_TMPL.format(topic=topic, recommendations=recommendations)
+
     try:
         # Run the agent
         logger.info(f"Generating context adaptations for {topic} using {'fast' if use_fast_research else 'deep'} research...")
-        response = agent.run(prompt)
-
-        # Process response
-        if response and response.content:
-            result = str(response.content)
-            logger.info(f"Generated context adaptations: {len(result)} chars")
-
-            # Cache the result
-            if use_cache:
-                try:
-                    cache = {}
-                    if os.path.exists(cache_file):
-                        with open(cache_file, "r") as f:
-                            cache = json.load(f)
-                    cache[cache_key] = result
-                    with open(cache_file, "w") as f:
-                        json.dump(cache, f)
-                except Exception as e:
-                    logger.error(f"Error writing to cache: {str(e)}")
-
-            return result
-        else:
-            logger.error(f"Failed to generate context adaptations for {topic}")
-            return "## Contextual Adaptations\n\nNo setting-specific adaptations could be generated. Please check the logs for details."
+        result = await run_agent(prompt, use_fast_research, on_chunk)
     except Exception as e:
         logger.error(f"Error generating context adaptations: {str(e)}")
-        return f"## Contextual Adaptations\n\nAn error occurred while generating setting-specific adaptations: {str(e)}"
+        raise ResearchError(f"## Contextual Adaptations\n\nAn error occurred while generating setting-specific adaptations: {str(e)}") from e
+
+    # Process response
+    if not result:
+        logger.error(f"Failed to generate context adaptations for {topic}")
+        raise ResearchError("## Contextual Adaptations\n\nNo setting-specific adaptations could be generated. Please check the logs for details.")
+
+    logger.info(f"Generated context adaptations: {len(result)} chars")
+    return result
 
 def extract_recommendations(sections_content):
     """Extract key recommendations from sections content for context adaptation"""
     # Look for recommendations in the content
     recommendations = []
     
-    # Look for table rows that contain recommendations
-    table_rows = re.findall(r'\|.*\|.*\|', sections_content)
-    for row in table_rows:
+    # Look for table rows that contain recommendations, stopping once we have the first 10
+    for match in _TABLE_ROW_RE.finditer(sections_content):
+        row = match.group(0)
         if 'Updated Recommendation' in row or 'Grade' in row:
             continue  # Skip header rows
         if '**' in row:  # Look for bold text which indicates changes
             recommendations.append(row.strip())
+            if len(recommendations) >= 10:
+                break
     
     # If no recommendations found in tables, look for numbered lists
     if not recommendations:
-        lines = sections_content.split('\n')
-        for i, line in enumerate(lines):
-            if re.match(r'^\d+\.\s+', line.strip()):
+        for line in sections_content.splitlines():
+            if _NUM_LIST_RE.match(line.strip()):
                 recommendations.append(line.strip())
-    
-    # If we found more than 10 recommendations, just take the first 10
-    if len(recommendations) > 10:
-        recommendations = recommendations[:10]
+                if len(recommendations) >= 10:
+                    break
     
     # If we found at least some recommendations, format them nicely
     if recommendations:
@@ -1103,97 +1667,54 @@ def extract_recommendations(sections_content):
 
 def extract_numbered_references(content):
     """Extract numbered references from the document"""
-    # Look for patterns like "[1] Author et al..." or "1. Author et al..."
-    lines = content.split("\n")
-    references = []
-    ref_pattern1 = re.compile(r'^\d+\.\s+.+')  # Matches "1. Reference..."
-    ref_pattern2 = re.compile(r'^\[\d+\]\s+.+')  # Matches "[1] Reference..."
-    
-    for line in lines:
-        if ref_pattern1.match(line.strip()) or ref_pattern2.match(line.strip()):
-            if not line.strip().startswith('1. **"') and "**" not in line:  # Avoid capturing recommendation numbers
-                references.append(line.strip())
-    
-    # Look for any "References" section with numeric items
-    if "References" in content:
-        ref_sections = content.split("References")
-        for ref_section in ref_sections[1:]:  # Skip the text before "References"
-            section_lines = ref_section.split("\n")
-            for line in section_lines:
-                if ref_pattern1.match(line.strip()) or ref_pattern2.match(line.strip()):
-                    references.append(line.strip())
-    
-    # Remove duplicates
-    unique_references = []
-    seen = set()
-    for ref in references:
-        if ref not in seen:
-            unique_references.append(ref)
-            seen.add(ref)
-    
-    return "\n".join(unique_references)
-
-def extract_references_from_content(content):
-    """Extract references section from content if it exists"""
+    # Look for patterns like "[1] Author et al..." or "1. Author et al..." in a single pass;
+    # dict keys keep the first occurrence of each reference in order
+    references = {}
+    in_refs_section = False
+
+    for line in content.splitlines():
+        stripped = line.strip()
+        if _NUMBERED_REF_RE.match(stripped):
+            # Outside a "References" section, skip numbered recommendations
+            if in_refs_section or (not stripped.startswith('1. **"') and "**" not in line):
+                references[stripped] = None
+        if "References" in line:
+            in_refs_section = True
+
+    return "\n".join(references)
+
+def split_refs(content):
+    """Split content into the text before its references section and the references themselves"""
     if not content:
-        return ""
-        
-    if "## References" in content:
-        return content.split("## References")[1]
-    elif "### References" in content:
-        return content.split("### References")[1]
-    return ""
-
-def remove_references_section(content):
-    """Remove references section from content"""
-    if not content:
-        return ""
-        
-    if "## References" in content:
-        return content.split("## References")[0]
-    elif "### References" in content:
-        return content.split("### References")[0]
-    return content
+        return "", ""
+
+    # "## References" also matches "### References" headings
+    body, _, rest = content.partition("## References")
+    # A later references heading ends the section
+    refs = rest.partition("## References")[0]
+    return body, refs
 
 def combine_references(reference_lists):
     """Combine multiple reference lists into one, removing duplicates"""
     # Join all references
     combined = "\n\n".join([ref for ref in reference_lists if ref])
     
-    # Simple deduplication by line
-    if combined:
-        lines = combined.split("\n")
-        unique_lines = []
-        seen = set()
-        
-        for line in lines:
-            # Only add non-empty lines that haven't been seen before
-            if line.strip() and line not in seen:
-                unique_lines.append(line)
-                seen.add(line)
-        
-        return "\n".join(unique_lines)
-    
-    return ""
+    # Simple deduplication by line, keeping the first of each non-empty line in order
+    lines = (line for line in combined.split("\n") if line.strip())
+    return "\n".join(dict.fromkeys(lines))
 
 # Add a new function to assemble the document with adaptations
 def assemble_complete_guidelines_with_adaptations(metadata, sections_content, new_recommendations, conclusion, context_adaptations):
     """Assemble all parts into a complete guidelines document including context adaptations"""
-    # Extract title section from metadata (without references)
-    title_section = metadata.split("## References")[0] if "## References" in metadata else metadata
-    
-    # Extract references section from metadata
-    references_section = ""
-    if "## References" in metadata:
-        references_section = metadata.split("## References")[1]
+    # Split every part into its body and references once
+    title_section, references_section = split_refs(metadata)
+    sections_body, refs_from_sections = split_refs(sections_content)
+    new_recs_body, refs_from_new_recs = split_refs(new_recommendations)
+    conclusion_body, refs_from_conclusion = split_refs(conclusion)
+    context_body, refs_from_context = split_refs(context_adaptations)
     
     # If there are no references in metadata, look in other sections
     if not references_section or references_section.strip() == "":
-        refs_from_sections = extract_references_from_content(sections_content)
-        refs_from_new_recs = extract_references_from_content(new_recommendations) if new_recommendations else ""
-        refs_from_conclusion = extract_references_from_content(conclusion) if conclusion else ""
-        refs_from_context = extract_references_from_content(context_adaptations) if context_adaptations else ""
-        
         # Combine all references found
         all_refs = combine_references([refs_from_sections, refs_from_new_recs, refs_from_conclusion, refs_from_context])
         
@@ -1210,100 +1731,104 @@ def assemble_complete_guidelines_with_adaptations(metadata, sections_content, ne
             references_section = "[References will be added here]"
 
     # Clean up the sections content but preserve tables
-    clean_sections_content = remove_references_section(sections_content).strip()
-    clean_new_recommendations = remove_references_section(new_recommendations).strip() if new_recommendations else ""
-    clean_conclusion = remove_references_section(conclusion).strip() if conclusion else ""
-    clean_context_adaptations = remove_references_section(context_adaptations).strip() if context_adaptations else ""
+    clean_sections_content = sections_body.strip()
+    clean_new_recommendations = new_recs_body.strip()
+    clean_conclusion = conclusion_body.strip()
+    clean_context_adaptations = context_body.strip()
     
     # Create table of contents
     toc = create_table_of_contents_with_adaptations(
-        clean_sections_content, 
-        clean_new_recommendations, 
-        clean_conclusion,
-        clean_context_adaptations
+        parse_structure(clean_sections_content),
+        parse_structure(clean_new_recommendations),
+        parse_structure(clean_conclusion),
+        parse_structure(clean_context_adaptations)
     )
     
-    # Assemble the document with enhanced formatting
-    document = title_section.strip() + "\n\n"
-    document += "---\n\n"  # Add separator
-    document += toc + "\n\n"
-    document += "---\n\n"  # Add separator
-    
-    document += "## 📋 Side-by-Side Comparison of Recommendations\n\n"
-    document += clean_sections_content + "\n\n"
-    document += "---\n\n"  # Add separator
+    # Assemble the document with enhanced formatting, joining the parts once at the end
+    parts = [
+        title_section.strip(), "\n\n",
+        "---\n\n",  # Add separator
+        toc, "\n\n",
+        "---\n\n",  # Add separator
+        "## 📋 Side-by-Side Comparison of Recommendations\n\n",
+        clean_sections_content, "\n\n",
+        "---\n\n",  # Add separator
+    ]
 
     if clean_new_recommendations:
-        document += "## 🆕 New Recommendations\n\n"
-        document += clean_new_recommendations + "\n\n"
-        document += "---\n\n"  # Add separator
+        parts.extend(["## 🆕 New Recommendations\n\n", clean_new_recommendations, "\n\n", "---\n\n"])
 
     if clean_conclusion:
-        document += "## 📝 Conclusion and Implementation\n\n"
-        document += clean_conclusion + "\n\n"
-        document += "---\n\n"  # Add separator
-        
+        parts.extend(["## 📝 Conclusion and Implementation\n\n", clean_conclusion, "\n\n", "---\n\n"])
+
     # Add context adaptations if available
     if clean_context_adaptations:
-        document += "## 🏥 Setting-Specific Adaptations\n\n"
-        document += clean_context_adaptations + "\n\n"
-        document += "---\n\n"  # Add separator
+        parts.extend(["## 🏥 Setting-Specific Adaptations\n\n", clean_context_adaptations, "\n\n", "---\n\n"])
 
     # Always add references at the end with proper formatting
-    document += "## 📚 References\n\n" + references_section.strip()
+    parts.extend(["## 📚 References\n\n", references_section.strip()])
 
-    return document
+    return "".join(parts)
 
-def create_table_of_contents_with_adaptations(sections_content, new_recommendations, conclusion, context_adaptations):
-    """Create a table of contents for the document including context adaptations"""
+# Characters replaced or dropped when turning a heading into a link anchor
+_SLUG_TABLE = str.maketrans({" ": "-", "(": "", ")": "", "[": "", "]": "", ",": "", ".": ""})
+
+def slugify(heading):
+    """Turn a heading into its markdown link anchor"""
+    return heading.lower().translate(_SLUG_TABLE)
+
+def parse_structure(md):
+    """Scan a markdown fragment once for the level-3 headings the table of contents needs"""
+    return {"h3_titles": _SECTION_RE.findall(md) if md else [], "length": len(md) if md else 0}
+
+def create_table_of_contents_with_adaptations(sections_structure, new_recs_structure, conclusion_structure, context_structure):
+    """Create a table of contents for the document including context adaptations from pre-parsed structures"""
     toc = "## Table of Contents\n\n"
     
     # Add section for recommendations comparison
     toc += "1. [Side-by-Side Comparison of Recommendations](#side-by-side-comparison-of-recommendations)\n"
     
-    # Extract section names from sections_content
-    section_names = re.findall(r'### ([^\n]+)', sections_content)
-    for i, section in enumerate(section_names):
+    # Section names from sections_content
+    for section in sections_structure["h3_titles"]:
         # Create anchor from section name
-        anchor = section.lower().replace(' ', '-').replace('(', '').replace(')', '')
+        anchor = slugify(section)
         toc += f"   - [{section}](#{anchor})\n"
     
     # Initialize counter for the remaining sections
     section_num = 2
     
     # Add new recommendations if present
-    if new_recommendations:
+    if new_recs_structure["length"]:
         toc += f"{section_num}. [New Recommendations](#new-recommendations)\n"
-        # Extract new recommendation categories
-        new_rec_categories = re.findall(r'### ([^\n]+)', new_recommendations)
-        for i, category in enumerate(new_rec_categories):
+        # New recommendation categories
+        for category in new_recs_structure["h3_titles"]:
             # Create anchor from category name
-            anchor = category.lower().replace(' ', '-').replace('(', '').replace(')', '')
+            anchor = slugify(category)
             toc += f"   - [{category}](#{anchor})\n"
         section_num += 1
     
     # Add conclusion if present
-    if conclusion:
+    if conclusion_structure["length"]:
         toc += f"{section_num}. [Conclusion and Implementation](#conclusion-and-implementation)\n"
         
-        # Extract conclusion subsections
-        conclusion_subsections = re.findall(r'### ([^\n]+)', conclusion)
-        for i, subsection in enumerate(conclusion_subsections):
+        # Conclusion subsections
+        for subsection in conclusion_structure["h3_titles"]:
             # Create anchor from subsection name
-            anchor = subsection.lower().replace(' ', '-').replace('(', '').replace(')', '')
+            anchor = slugify(subsection)
             toc += f"   - [{subsection}](#{anchor})\n"
         section_num += 1
     
     # Add context adaptations if present
-    if context_adaptations:
+    if context_structure["length"]:
         toc += f"{section_num}. [Setting-Specific Adaptations](#setting-specific-adaptations)\n"
         
-        # Extract adaptation subsections
-        adaptation_subsections = re.findall(r'### (\d+\.\s+[^\n]+)', context_adaptations)
-        for i, subsection in enumerate(adaptation_subsections):
+        # Adaptation subsections are the numbered level-3 headings
+        for subsection in context_structure["h3_titles"]:
+            if not _NUM_LIST_RE.match(subsection):
+                continue
             # Create anchor from subsection name
             clean_subsection = subsection.split('.', 1)[1].strip()
-            anchor = clean_subsection.lower().replace(' ', '-').replace('(', '').replace(')', '')
+            anchor = slugify(clean_subsection)
             toc += f"   - [{clean_subsection}](#{anchor})\n"
         section_num += 1
     
@@ -1312,6 +1837,44 @@ def create_table_of_contents_with_adaptations(sections_content, new_recommendati
     
     return toc
 
+# Session state keys holding the latest finished document and its derived download data
+RESULT_STATE_KEYS = ("markdown_content", "doc_stats", "doc_bytes", "safe_topic", "html_content", "html_error")
+
+# Function to show the finished document and its download options from session state
+def render_results(result_container):
+    """Render the stored document, its summary and the download buttons"""
+    doc_length, completed_parts = st.session_state["doc_stats"]
+    safe_topic = st.session_state["safe_topic"]
+
+    # Show document information
+    st.write(f"Document length: {doc_length} characters")
+    st.write(f"Completed parts: {completed_parts}")
+
+    # Display final result
+    result_container.markdown(st.session_state["markdown_content"])
+
+    # Download buttons
+    st.subheader("Download Options")
+    col_dl1, col_dl2 = st.columns(2)
+    with col_dl1:
+        st.download_button(
+            label="📥 Download as Markdown",
+            data=st.session_state["doc_bytes"],
+            file_name=f"{safe_topic}_guideline_update.md",
+            mime="text/markdown",
+        )
+
+    with col_dl2:
+        if st.session_state.get("html_content") is not None:
+            st.download_button(
+                label="📄 Download as HTML",
+                data=st.session_state["html_content"],
+                file_name=f"{safe_topic}_guideline_update.html",
+                mime="text/html",
+            )
+        else:
+            st.warning(st.session_state.get("html_error") or "HTML version is unavailable for this document.")
+
 # Streamlit App
 def main():
     st.set_page_config(
@@ -1339,8 +1902,9 @@ def main():
         """
     )
 
-    # Create tmp directory if it doesn't exist
-    os.makedirs("tmp", exist_ok=True)
+    start_cache_purge()
+    # Start loading the tokenizer now, so it is ready before the first prompt is sized
+    _token_encoding_future()
 
     # Sidebar
     with st.sidebar:
@@ -1387,8 +1951,19 @@ def main():
             include_context_adaptations = st.checkbox("Generate Setting-Specific Adaptations", value=True,
                                                       help="Creates context-specific versions for different healthcare settings")
             use_cache = st.checkbox("Use Cached Results (if available)", value=True)
+            if st.button("Clear Cache", help="Delete all cached research so the next run queries Perplexity again"):
+                removed = cache_store.clear()
+                st.cache_data.clear()
+                logger.info(f"Cleared {removed} cached results")
+                st.success(f"Cleared {removed} cached results")
             chunked_generation = st.checkbox("Use Chunked Generation for Long Outputs", value=True,
                                              help="Breaks generation into smaller pieces to avoid truncation")
+            # The fast research fallback races whole-section prompts, so it only applies without chunked generation
+            speculative_research = st.checkbox("Fall Back to Fast Research for Slow Sections", value=False,
+                                               disabled=chunked_generation or use_fast_research,
+                                               help="Runs fast research alongside deep research and uses it when deep research is too slow. "
+                                                    "Only available for deep research without chunked generation")
+            speculative_research = speculative_research and not chunked_generation and not use_fast_research
 
         submit = st.button("Generate Updated Guidelines", type="primary")
 
@@ -1417,9 +1992,16 @@ def main():
         st.subheader("Updated Guidelines")
         result_container = st.empty()
 
+    # Open the Perplexity connection while the user is still filling in the form
+    if not submit and time.monotonic() - st.session_state.get("perplexity_warmed_at", 0) > PERPLEXITY_WARMUP_INTERVAL:
+        st.session_state["perplexity_warmed_at"] = time.monotonic()
+        warm_perplexity_connection()
+
     if submit:
-        # Clear the result container
+        # Clear the result container and drop the previous document, so a failed run does not show stale results
         result_container.empty()
+        for key in RESULT_STATE_KEYS:
+            st.session_state.pop(key, None)
 
         with process_container:
             st.write("**Research & Generation Process:**")
@@ -1442,253 +2024,341 @@ def main():
         completed_parts = []
 
         try:
-            # Status update function with the fix for st.progress
-            def update_status(message, progress_value):
+            # Highest progress shown so far; concurrent steps report their progress out of order
+            progress_high_water = 0
+            # Status and progress bar are re-rendered at most once per UI_UPDATE_INTERVAL seconds;
+            # a throttled update is kept as pending and flushed once the interval has passed
+            last_ui_update = 0.0
+            pending_status = None
+
+            def render_status():
+                nonlocal last_ui_update, pending_status
+                if pending_status is None:
+                    return
+                logged_at, message, progress_value = pending_status
+                pending_status = None
+                last_ui_update = time.monotonic()
+                # The status log only shows the latest message, so it is updated along with the header
+                status_log.write(f"{logged_at.strftime('%H:%M:%S')} - {message}")
                 status.markdown(f"### {message}")
                 # FIX: Divide progress_value by 100.0 to get value between 0.0 and 1.0
                 progress.progress(progress_value / 100.0)
-                status_log.write(f"{datetime.datetime.now().strftime('%H:%M:%S')} - {message}")
-                time.sleep(0.1) # Reduced sleep time for potentially faster updates
+
+            # Status update function with the fix for st.progress; immediate updates (finishing or
+            # resetting on failure) skip the throttle and may move the bar backwards
+            def update_status(message, progress_value, immediate=False):
+                nonlocal progress_high_water, pending_status
+                # Never move the bar backwards otherwise; concurrent steps report out of order
+                if immediate or progress_value > progress_high_water:
+                    progress_high_water = progress_value
+
+                flush_scheduled = pending_status is not None
+                pending_status = (datetime.datetime.now(), message, progress_high_water)
+                wait = UI_UPDATE_INTERVAL - (time.monotonic() - last_ui_update)
+                if immediate or wait <= 0:
+                    render_status()
+                elif not flush_scheduled:
+                    try:
+                        asyncio.get_running_loop().call_later(wait, render_status)
+                    except RuntimeError:
+                        # Outside the event loop there is nothing to flush later
+                        render_status()
+
+            # Research steps share the bar up to 98%; the rest is left for assembling the document
+            tracker = ProgressTracker({
+                "metadata": 2,
+                "sections": 5,
+                "new_recommendations": 1 if include_new else 0,
+                "conclusion": 1 if include_conclusion else 0,
+                "context_adaptations": 1 if include_context_adaptations else 0,
+            }, update_status, total=98)
+
+            # Build a callback that renders a streamed response into a placeholder as it arrives
+            def stream_to(placeholder):
+                buffer = []
+                last_render = 0.0
+
+                def on_chunk(text):
+                    nonlocal last_render
+                    buffer.append(text)
+                    # Coalesce chunks into at most one re-render per interval; callers render the full result at the end
+                    now = time.monotonic()
+                    if now - last_render >= STREAM_RENDER_INTERVAL:
+                        last_render = now
+                        placeholder.markdown("".join(buffer))
+
+                return on_chunk
+
+            # Build a callback that renders every section into one shared placeholder, in section order;
+            # streamed chunks are appended to a section, and a final result replaces what was streamed
+            def stream_sections_to(placeholder, count):
+                slots = [[] for _ in range(count)]
+                last_render = 0.0
+
+                def update_section(index, text, final=False):
+                    nonlocal last_render
+                    if final:
+                        slots[index] = [text]
+                    else:
+                        slots[index].append(text)
+                    # Re-render at most once per interval; callers render the full results at the end
+                    now = time.monotonic()
+                    if now - last_render >= STREAM_RENDER_INTERVAL:
+                        last_render = now
+                        placeholder.markdown(SECTION_SEPARATOR.join("".join(slot) for slot in slots if slot))
+
+                return update_section
 
             # Helper function to handle section research with progress tracking
-            def research_section_with_progress(topic, section, section_index, total_sections, use_fast_research=False, use_cache=True):
-                # Calculate progress percentage for this section
-                # Adjust progress allocation to accommodate contextual adaptations
-                section_progress_total = 50 if include_context_adaptations else 60
-                start_percent = 20 + (section_index * section_progress_total / total_sections)
-                end_percent = 20 + ((section_index + 1) * section_progress_total / total_sections)
+            # Sections run concurrently, so progress follows how many have finished rather than their order
+            sections_completed = 0
 
+            async def research_section_with_progress(topic, section, section_index, total_sections, use_fast_research=False, use_cache=True, update_section=None):
+                nonlocal sections_completed
                 # Update status
-                update_status(f"Researching {section} section...", start_percent)
+                update_status(f"Researching {section} section...", tracker.done)
 
-                # Execute research
-                if chunked_generation:
-                    # Break the research into smaller chunks for complex sections
-                    result = research_section_chunked(topic, section, use_fast_research, use_cache)
-                else:
-                    # Use the standard function
-                    result = research_guideline_section(topic, section, use_fast_research, use_cache)
+                # Break the research into smaller chunks for complex sections
+                try:
+                    result = await research_section_chunked(topic, section, use_fast_research, use_cache)
+                except Exception as e:
+                    # One failed section shouldn't discard the others researched alongside it
+                    logger.error(f"Error researching {section}: {str(e)}")
+                    result = f"### {section}\n\nAn error occurred while researching this section: {str(e)}"
+
+                # Show the section in its own slot as soon as it is ready
+                if update_section:
+                    update_section(section_index, result, final=True)
 
                 # Update progress
-                # Ensure the progress reaches the end of the step even if the function returns quickly
-                update_status(f"Completed {section} section", end_percent)
+                sections_completed += 1
+                tracker.advance("sections", 1 / total_sections, f"Completed {section} section ({sections_completed}/{total_sections})")
 
                 return result
 
-            # Added a check here as the agent creation might fail without the API key
-            if not perplexity_api_key and 'Agent' in globals() and 'Perplexity' in globals():
-                st.error("PERPLEXITY_API_KEY is not set. Please set the environment variable to proceed.")
-                update_status("Generation Failed", 0) # Reset progress on error
-                return # Stop execution if API key is missing
-
-            # STEP 1: Research metadata and executive summary
-            # Allocate 20% progress to metadata/exec summary
-            update_status("Researching guideline metadata and writing executive summary...", 10)
-
-            # Generate metadata (executive summary, etc.)
-            metadata_result = research_guideline_metadata(topic, use_fast_research, use_cache)
-            completed_parts.append("metadata")
-
-            # Display in expander
-            with metadata_expander:
-                st.markdown(metadata_result)
-
-            # Ensure progress reaches 20% after this step
-            update_status("Executive summary complete", 20)
-
-            # STEP 2: Research each section separately
-            sections_results = []
-            total_sections = len(sections)
-            # Check if there are sections to process to avoid potential division by zero
-            if total_sections == 0:
-                st.warning("No clinical sections selected to research.")
-            else:
-                for i, section in enumerate(sections):
-                    section_result = research_section_with_progress(
-                        topic, section, i, total_sections, use_fast_research, use_cache
-                    )
-                    sections_results.append(section_result)
+            # Run the whole research workflow inside a single event loop
+            async def run_workflow():
+                # Added a check here as the agent creation might fail without the API key
+                if not perplexity_api_key and 'Agent' in globals() and 'Perplexity' in globals():
+                    st.error("PERPLEXITY_API_KEY is not set. Please set the environment variable to proceed.")
+                    update_status("Generation Failed", 0, immediate=True) # Reset progress on error
+                    return # Stop execution if API key is missing
+
+                # STEP 1: Research metadata and executive summary
+                async def research_metadata_step():
+                    with tracker.scope("metadata", "Researching guideline metadata and writing executive summary...",
+                                       "Executive summary complete"):
+                        # Generate metadata (executive summary, etc.)
+                        metadata_placeholder = metadata_expander.empty()
+                        metadata_result = await research_guideline_metadata(
+                            topic, use_fast_research, use_cache, stream_to(metadata_placeholder)
+                        )
+                    completed_parts.append("metadata")
 
                     # Display in expander
-                    with sections_expander:
-                        st.markdown(section_result)
-
-                    # Small delay to avoid rate limiting
-                    time.sleep(0.5)
-
-            # Combine all section results
-            combined_sections = "\n\n".join(sections_results)
-            completed_parts.append("sections")
-
-            # Adjust progress allocations based on included components
-            progress_allocation = {}
-            remaining_progress = 100 - (20 + (50 if include_context_adaptations else 60))
-            components_count = sum([include_new, include_conclusion, include_context_adaptations])
-            
-            if components_count > 0:
-                progress_per_component = remaining_progress / components_count
-                if include_new:
-                    progress_allocation["new_recommendations"] = progress_per_component
-                if include_conclusion:
-                    progress_allocation["conclusion"] = progress_per_component
-                if include_context_adaptations:
-                    progress_allocation["context_adaptations"] = progress_per_component
-
-            # Calculate starting progress for each component
-            current_progress = 20 + (50 if include_context_adaptations else 60)
-            
-            # STEP 3: Research new recommendations if requested
-            new_recommendations_result = ""
-            if include_new:
-                # Use allocated progress for new recommendations
-                start_progress = current_progress
-                end_progress = current_progress + progress_allocation["new_recommendations"]
-                current_progress = end_progress
-                
-                update_status("Researching potential new recommendations...", start_progress)
-
-                # Generate new recommendations
-                if chunked_generation:
-                    new_recommendations_result = research_new_recommendations_chunked(topic, use_fast_research, use_cache)
-                else:
-                    new_recommendations_result = research_new_recommendations(topic, use_fast_research, use_cache)
-
-                completed_parts.append("new_recommendations")
-
-                # Display in expander (check if new_recs_expander exists)
-                if new_recs_expander:
-                    with new_recs_expander:
-                        st.markdown(new_recommendations_result)
-
-                # Update progress
-                update_status("New recommendations complete", end_progress)
-
-            # STEP 4: Generate conclusion if requested
-            conclusion_result = ""
-            if include_conclusion:
-                # Use allocated progress for conclusion
-                start_progress = current_progress
-                end_progress = current_progress + progress_allocation["conclusion"]
-                current_progress = end_progress
-                
-                update_status("Creating comprehensive conclusion...", start_progress)
-
-                # Generate conclusion
-                conclusion_result = research_comprehensive_conclusion(
-                    topic, metadata_result, combined_sections, use_fast_research, use_cache
-                )
-
-                completed_parts.append("conclusion")
+                    metadata_placeholder.markdown(metadata_result)
+
+                    return metadata_result
+
+                # STEP 2: Research each section separately
+                async def research_sections_step():
+                    sections_results = []
+                    total_sections = len(sections)
+                    with tracker.scope("sections", f"Researching {total_sections} sections...", "Completed all sections"):
+                        # All sections render into one placeholder, which keeps them in section order as they finish
+                        sections_placeholder = sections_expander.empty()
+                        update_section = stream_sections_to(sections_placeholder, total_sections)
+                        # Check if there are sections to process to avoid potential division by zero
+                        if total_sections == 0:
+                            st.warning("No clinical sections selected to research.")
+                        elif not chunked_generation:
+                            # Send every section prompt as one batch instead of one request at a time
+                            section_indexes = {section: i for i, section in enumerate(sections)}
+                            if speculative_research:
+                                sections_results = await asyncio.gather(*[
+                                    research_guideline_section_speculative(
+                                        topic, section, use_cache, functools.partial(update_section, i)
+                                    )
+                                    for i, section in enumerate(sections)
+                                ])
+                            else:
+                                sections_results = await research_guideline_sections(
+                                    topic, sections, use_fast_research, use_cache,
+                                    lambda section, text: update_section(section_indexes[section], text)
+                                )
+                        else:
+                            # Sections are independent, so research them concurrently; the limiter paces the requests
+                            sections_results = await asyncio.gather(*[
+                                research_section_with_progress(topic, section, i, total_sections, use_fast_research, use_cache, update_section)
+                                for i, section in enumerate(sections)
+                            ])
+
+                        # Display in expander
+                        if sections_results:
+                            sections_placeholder.markdown(SECTION_SEPARATOR.join(sections_results))
+
+                    completed_parts.append("sections")
+                    return sections_results
+
+                # STEP 3: Research new recommendations if requested
+                async def research_new_recs_step():
+                    if not include_new:
+                        return ""
+
+                    with tracker.scope("new_recommendations", "Researching potential new recommendations...",
+                                       "New recommendations complete"):
+                        new_recs_placeholder = new_recs_expander.empty()
+
+                        # Generate new recommendations
+                        if chunked_generation:
+                            new_recommendations_result = await research_new_recommendations_chunked(topic, use_fast_research, use_cache)
+                        else:
+                            new_recommendations_result = await research_new_recommendations(
+                                topic, use_fast_research, use_cache, stream_to(new_recs_placeholder)
+                            )
+
+                    completed_parts.append("new_recommendations")
 
-                # Display in expander (check if conclusion_expander exists)
-                if conclusion_expander:
-                    with conclusion_expander:
-                        st.markdown(conclusion_result)
-
-                # Update progress
-                update_status("Conclusion complete", end_progress)
-
-            # STEP 5: Generate contextual adaptations if requested
-            context_adaptations_result = ""
-            if include_context_adaptations:
-                # Use allocated progress for contextual adaptations
-                start_progress = current_progress
-                end_progress = current_progress + progress_allocation["context_adaptations"]
-                current_progress = end_progress
-                
-                update_status("Generating setting-specific adaptations...", start_progress)
-
-                # Generate contextual adaptations
-                context_adaptations_result = generate_context_adaptations(
-                    topic, combined_sections, use_fast_research, use_cache
+                    # Display in expander
+                    new_recs_placeholder.markdown(new_recommendations_result)
+                    return new_recommendations_result
+
+                # Metadata, sections and new recommendations don't depend on each other, so run them together;
+                # each step moves the progress bar by its own share when it finishes
+                metadata_result, sections_results, new_recommendations_result = await asyncio.gather(
+                    research_metadata_step(),
+                    research_sections_step(),
+                    research_new_recs_step(),
+                    return_exceptions=True
                 )
+                if isinstance(metadata_result, Exception):
+                    logger.error(f"Error researching metadata: {str(metadata_result)}")
+                    metadata_result = f"## Executive Summary\n\nAn error occurred while researching the executive summary: {str(metadata_result)}"
+                if isinstance(sections_results, Exception):
+                    logger.error(f"Error researching sections: {str(sections_results)}")
+                    sections_results = []
+                if isinstance(new_recommendations_result, Exception):
+                    logger.error(f"Error researching new recommendations: {str(new_recommendations_result)}")
+                    new_recommendations_result = ""
+
+                # Combine all section results
+                combined_sections = "\n\n".join(sections_results)
+
+                # STEP 4: Generate conclusion if requested
+                async def research_conclusion_step():
+                    if not include_conclusion:
+                        return ""
+
+                    with tracker.scope("conclusion", "Creating comprehensive conclusion...", "Conclusion complete"):
+                        conclusion_placeholder = conclusion_expander.empty()
+
+                        # Generate conclusion, showing it as it streams in
+                        conclusion_result = await research_comprehensive_conclusion(
+                            topic, metadata_result, combined_sections, use_fast_research, use_cache,
+                            stream_to(conclusion_placeholder)
+                        )
+
+                    completed_parts.append("conclusion")
 
-                completed_parts.append("context_adaptations")
-
-                # Display in expander (check if context_expander exists)
-                if context_expander:
-                    with context_expander:
-                        st.markdown(context_adaptations_result)
-
-                # Update progress
-                update_status("Setting-specific adaptations complete", end_progress)
-
-            # FINAL STEP: Assemble the complete document
-            # Allocate remaining progress to assembly and final display
-            update_status("Assembling complete guidelines document...", 98)
-
-            # Assemble document based on completed parts
-            complete_document = assemble_complete_guidelines_with_adaptations(
-                metadata_result,
-                combined_sections,
-                new_recommendations_result,
-                conclusion_result,
-                context_adaptations_result
-            )
+                    # Display in expander
+                    conclusion_placeholder.markdown(conclusion_result)
+                    return conclusion_result
 
-            # Final update
-            update_status("✅ Guidelines research and update complete!", 100)
+                # STEP 5: Generate contextual adaptations if requested
+                async def research_context_adaptations_step():
+                    if not include_context_adaptations:
+                        return ""
 
-            # Show document information
-            st.write(f"Document length: {len(complete_document)} characters")
-            st.write(f"Completed parts: {', '.join(completed_parts)}")
+                    with tracker.scope("context_adaptations", "Generating setting-specific adaptations...",
+                                       "Setting-specific adaptations complete"):
+                        context_placeholder = context_expander.empty()
 
-            # Store in session state for download
-            st.session_state["markdown_content"] = complete_document
+                        # Generate contextual adaptations, showing them as they stream in
+                        context_adaptations_result = await generate_context_adaptations(
+                            topic, combined_sections, use_fast_research, use_cache,
+                            stream_to(context_placeholder)
+                        )
 
-            # Display final result
-            result_container.markdown(complete_document)
+                    completed_parts.append("context_adaptations")
 
-            # Download buttons
-            st.subheader("Download Options")
-            col_dl1, col_dl2 = st.columns(2)
-            with col_dl1:
-                st.download_button(
-                    label="📥 Download as Markdown",
-                    data=complete_document,
-                    file_name=f"{topic.replace(' ', '_')}_guideline_update.md",
-                    mime="text/markdown",
+                    # Display in expander
+                    context_placeholder.markdown(context_adaptations_result)
+                    return context_adaptations_result
+
+                # The conclusion and adaptations both build on the sections but not on each other;
+                # each step renders its own expander and moves the progress bar as soon as it finishes
+                conclusion_result, context_adaptations_result = await asyncio.gather(
+                    research_conclusion_step(),
+                    research_context_adaptations_step(),
+                    return_exceptions=True
+                )
+                if isinstance(conclusion_result, Exception):
+                    logger.error(f"Error creating conclusion: {str(conclusion_result)}")
+                    conclusion_result = ""
+                if isinstance(context_adaptations_result, Exception):
+                    logger.error(f"Error generating setting-specific adaptations: {str(context_adaptations_result)}")
+                    context_adaptations_result = ""
+
+                # FINAL STEP: Assemble the complete document
+                # Allocate remaining progress to assembly and final display
+                update_status("Assembling complete guidelines document...", 98)
+
+                # Assemble document based on completed parts
+                complete_document = assemble_complete_guidelines_with_adaptations(
+                    metadata_result,
+                    combined_sections,
+                    new_recommendations_result,
+                    conclusion_result,
+                    context_adaptations_result
                 )
 
-            with col_dl2:
-                # Convert to HTML for better printing
+                # Final update
+                update_status("✅ Guidelines research and update complete!", 100, immediate=True)
+
+                # Store the finished document and everything derived from it in session state, so reruns
+                # (e.g. clicking a download button) render the results without redoing any string work
+                st.session_state["markdown_content"] = complete_document
+                st.session_state["doc_stats"] = (len(complete_document), ", ".join(completed_parts))
+                # Encode the document once and reuse the bytes for the downloads and the saved file;
+                # replacing unencodable code points means encoding can never fail
+                doc_bytes = complete_document.encode("utf-8", errors="replace")
+                st.session_state["doc_bytes"] = doc_bytes
+                # Use a safer filename by replacing non-alphanumeric chars, for both downloads and the saved file
+                safe_topic = _SAFE_TOPIC_RE.sub('_', topic)
+                st.session_state["safe_topic"] = safe_topic
+                # Convert to HTML for better printing once per finished run, so reruns only read the stored bytes
+                st.session_state["html_error"] = None
                 try:
                     import markdown
-                    html_content = markdown.markdown(complete_document)
-                    st.download_button(
-                        label="📄 Download as HTML",
-                        data=html_content,
-                        file_name=f"{topic.replace(' ', '_')}_guideline_update.html",
-                        mime="text/html",
-                    )
+                    st.session_state["html_content"] = markdown.markdown(
+                        complete_document, extensions=["extra", "toc"]
+                    ).encode("utf-8")
                 except ImportError:
-                    st.warning("Install 'markdown' library (`pip install markdown`) for HTML download option.")
+                    st.session_state["html_content"] = None
+                    st.session_state["html_error"] = "Install 'markdown' library (`pip install markdown`) for HTML download option."
                 except Exception as e:
-                    st.error(f"Could not create HTML version: {str(e)}")
+                    st.session_state["html_content"] = None
+                    st.session_state["html_error"] = f"Could not create HTML version: {str(e)}"
+                    logger.error(f"HTML conversion error: {str(e)}")
 
-            # Save file with proper encoding
-            try:
-                # Use a safer filename by replacing non-alphanumeric chars
-                safe_topic = re.sub(r'[^\w.-]', '_', topic)
-                output_filename = f"tmp/{safe_topic}_guideline_update.md"
-                with open(output_filename, "w", encoding="utf-8") as f:
-                    f.write(complete_document)
-                st.success(f"Output saved to {output_filename}")
-            except Exception as e:
-                st.error(f"Could not save output file: {str(e)}")
-                # Fallback to ASCII saving with error ignoring
+                # Save file; the bytes are already UTF-8, so only disk or permission errors remain
+                output_filename = os.path.join(OUTPUT_DIR, f"{safe_topic}_guideline_update.md")
                 try:
-                    output_filename_ascii = f"tmp/{safe_topic}_guideline_update_ascii.md"
-                    with open(output_filename_ascii, "w", encoding="ascii", errors="ignore") as f:
-                        f.write(complete_document)
-                    st.warning(f"Output saved with ASCII encoding (some characters may be lost) to {output_filename_ascii}")
-                except Exception as e2:
-                    st.error(f"Could not save output with ASCII encoding: {str(e2)}")
+                    pathlib.Path(output_filename).write_bytes(doc_bytes)
+                    st.success(f"Output saved to {output_filename}")
+                except Exception as e:
+                    st.error(f"Could not save output file: {str(e)}")
+
+            asyncio.run(run_workflow())
 
         except Exception as e:
             st.error(f"An error occurred: {str(e)}")
             logger.error(f"Workflow error: {str(e)}")
-            update_status("Generation Failed", 0) # Ensure progress bar resets on error
+            update_status("Generation Failed", 0, immediate=True) # Ensure progress bar resets on error
+
+    # Show the latest finished document on every rerun, not only right after generating it
+    if "doc_bytes" in st.session_state:
+        render_results(result_container)
 
 if __name__ == "__main__":
     main()